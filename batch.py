@@ -0,0 +1,264 @@
+'''
+Module for pricing many cities and treatments at once without the tkinter window.
+
+Can be imported, or run from the command line:
+
+    python batch.py cities.csv --output prices.jsonl --workers 8
+'''
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, TextIO
+
+from constants import DATABASE_BACKEND, PARSE_PROCESSES, STAGE_WORKERS
+from exceptions import set_headless
+from pricing import PriceManager
+from scheduler import configure_process_pool
+from startup import report_startup
+from treatments import Treatment, TREATMENTS, get_treatment
+
+
+
+SAVE_EVERY = 25
+
+
+
+@dataclass(slots=True, frozen=True)
+class Job:
+    city: str
+    treatment: Treatment
+
+
+
+def read_jobs(path: str) -> list[Job]:
+    '''
+    Reads the jobs in a CSV or JSONL file.
+
+    CSV files need a `city` column and can have a `treatment` or `treatments` column (treatments separated by `;`).
+
+    JSONL files have one object per line with a `city` key and a `treatment` string or `treatments` list.
+
+    A row without any treatments prices every treatment.
+
+    Raises a `ValueError` naming the row if a row has no city or an unknown treatment.
+    '''
+
+    with open(path, newline='') as f:
+        if os.path.splitext(path)[1].lower() in ('.jsonl', '.json'):
+            rows = [json.loads(line) for line in f if line.strip()]
+
+        else:
+            rows = list(csv.DictReader(f))
+
+    jobs: list[Job] = []
+
+    for number, row in enumerate(rows, 1):
+        city = row.get('city') if isinstance(row, dict) else None
+
+        if not isinstance(city, str) or not city.strip():
+            raise ValueError(f'Row {number} of {path} has no city')
+
+        try:
+            treatments = _row_treatments(row)
+        except KeyError as exception:
+            raise ValueError(f'Row {number} of {path} has an unknown treatment {exception}') from None
+
+        for treatment in treatments:
+            jobs.append(Job(city.strip(), treatment))
+
+    return jobs
+
+
+
+def _row_treatments(row: dict[str, Any]) -> tuple[Treatment, ...]:
+    names = row.get('treatments') or row.get('treatment') or []
+
+    if isinstance(names, str):
+        names = [name for name in names.split(';') if name.strip()]
+
+    if not names:
+        return TREATMENTS
+
+    return tuple(map(get_treatment, names))
+
+
+
+def run_batch(jobs: Iterable[Job], update_database: bool = False, price_manager: PriceManager | None = None, merged: bool = False) -> Iterator[dict[str, Any]]:
+    '''
+    Queues every job on `price_manager`'s workers, yielding a result for each job as soon as it finishes.
+
+    If `merged` is set, the jobs for each city are queued together and share one search and GPT call.
+
+    Results are dicts with `city`, `treatment` and `price_per_minute` keys, or an `error` key instead of a price if the job failed.
+
+    The database is saved every `SAVE_EVERY` results and when the batch ends.
+
+    Turns off tkinter prompts, since nobody is there to answer them.
+    '''
+
+    set_headless(True)
+
+    if price_manager is None:
+        price_manager = PriceManager()
+
+    finished = 0
+
+    if merged:
+        cities: dict[str, list[Treatment]] = {}
+
+        for job in jobs:
+            cities.setdefault(job.city, []).append(job.treatment)
+
+        futures = {price_manager.submit_city(city, treatments, update_database): (city, treatments) for city, treatments in cities.items()}
+
+    else:
+        futures = {price_manager.submit(job.city, job.treatment, update_database): (job.city, [job.treatment]) for job in jobs}
+
+    try:
+        for future in as_completed(futures):
+            city, treatments = futures[future]
+
+            try:
+                prices = future.result()
+                error = None
+            except Exception as exception:
+                prices = {}
+                error = f'{type(exception).__name__}: {exception}'
+
+            # single treatment jobs return just the price
+            if not isinstance(prices, dict):
+                prices = {treatments[0].name: prices}
+
+            for treatment in treatments:
+                result: dict[str, Any] = {'city': city, 'treatment': treatment.name}
+
+                if treatment.name in prices:
+                    result['price_per_minute'] = prices[treatment.name]
+                else:
+                    result['error'] = error or 'No price found'
+
+                yield result
+
+                finished += 1
+
+                if finished % SAVE_EVERY == 0:
+                    price_manager.save()
+
+    finally:
+        # don't leave queued jobs running if the results stop being read
+        for future in futures:
+            future.cancel()
+
+        price_manager.save()
+
+
+
+def run_offline_batch(jobs: list[Job], backend_name: str, price_manager: PriceManager, poll_interval: float = 60.0) -> Iterator[dict[str, Any]]:
+    '''
+    Gets new prices for every job through a batch backend ('openai' or 'local'), yielding results in the same form as `run_batch` once the batch finishes.
+    '''
+
+    from gpt import BatchBackend, LocalBatchBackend, OpenAIBatchBackend
+
+    set_headless(True)
+
+    if backend_name == 'openai':
+        backend: BatchBackend = OpenAIBatchBackend(price_manager.gpt.client)
+    else:
+        backend = LocalBatchBackend(price_manager.gpt.send_request_body)
+
+    prices = price_manager.refresh_offline([(job.city, job.treatment) for job in jobs], backend, poll_interval)
+
+    for job in jobs:
+        result: dict[str, Any] = {'city': job.city, 'treatment': job.treatment.name}
+
+        if (job.city, job.treatment.name) in prices:
+            result['price_per_minute'] = prices[(job.city, job.treatment.name)]
+        else:
+            result['error'] = 'No reply in the batch'
+
+        yield result
+
+
+
+def write_results(results: Iterable[dict[str, Any]], output: TextIO) -> int:
+    '''
+    Writes each result to `output` as a line of JSON as soon as it arrives. Returns the number of results with a price.
+    '''
+
+    priced = 0
+
+    for result in results:
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+        if 'price_per_minute' in result:
+            priced += 1
+
+    return priced
+
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Get the prices per minute of treatments in many cities without opening the window.')
+    parser.add_argument('jobs', help='CSV or JSONL file of cities and treatments')
+    parser.add_argument('-o', '--output', help='JSONL file to write results to (defaults to stdout)')
+    parser.add_argument('-w', '--workers', type=int, default=STAGE_WORKERS['jobs'], help='number of treatments to price at once')
+    parser.add_argument('--search-workers', type=int, default=STAGE_WORKERS['search'], help='number of searches to run at once')
+    parser.add_argument('--fetch-workers', type=int, default=STAGE_WORKERS['fetch'], help='number of web pages to download at once')
+    parser.add_argument('--parse-processes', type=int, default=PARSE_PROCESSES, help='number of processes to parse web pages on (0 parses them on the fetching threads)')
+    parser.add_argument('--llm-workers', type=int, default=STAGE_WORKERS['llm'], help='number of GPT queries to run at once')
+    parser.add_argument('--database', choices=('sqlite', 'json'), default=DATABASE_BACKEND, help='where saved prices are kept')
+    parser.add_argument('--offline', choices=('openai', 'local'), help='get new prices for every job with one batch of GPT queries, using OpenAI\'s batch API or a local stand in that sends each query directly')
+    parser.add_argument('--poll-interval', type=float, default=60.0, help='seconds between checks on an offline batch')
+    parser.add_argument('-m', '--merged', action='store_true', help='price all of a city\'s treatments with one search and GPT call')
+    parser.add_argument('-e', '--estimate', action='store_true', help='estimate unsaved prices from nearby cities, only querying GPT when the estimate isn\'t confident')
+    parser.add_argument('-u', '--update', action='store_true', help='get new prices for treatments already in the database')
+
+    args = parser.parse_args(argv)
+
+    configure_process_pool(args.parse_processes)
+
+    try:
+        jobs = read_jobs(args.jobs)
+    except (OSError, ValueError) as exception:
+        parser.error(str(exception))
+
+    price_manager = PriceManager({
+        'jobs': args.workers,
+        'search': args.search_workers,
+        'fetch': args.fetch_workers,
+        'llm': args.llm_workers,
+    }, args.database, args.estimate)
+
+    report_startup('batch')
+
+    if args.offline:
+        results = run_offline_batch(jobs, args.offline, price_manager, args.poll_interval)
+
+    else:
+        results = run_batch(jobs, args.update, price_manager, args.merged)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            priced = write_results(results, f)
+
+    else:
+        priced = write_results(results, sys.stdout)
+
+    print(f'Priced {priced} of {len(jobs)} jobs', file=sys.stderr)
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    sys.exit(main())
@@ -0,0 +1,233 @@
+'''
+Module containing caches saved on disk, used to keep things like web pages and search results between runs
+'''
+
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+from typing import Any
+
+from constants import DATA_DIR
+
+
+
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+
+Metadata = dict[str, Any]
+
+
+
+def hash_key(*parts: str) -> str:
+    '''
+    Returns a file name safe hash of `parts`.
+    '''
+
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+
+class DiskCache:
+    '''
+    A cache of byte strings stored in `directory`, each with a dict of json metadata.
+
+    When the bodies add up to more than `max_bytes`, the least recently used entries are deleted.
+
+    Safe to use from many threads at once.
+    '''
+
+    __slots__ = ('directory', 'max_bytes', 'entries', 'total_bytes', 'lock')
+
+    def __init__(self, name: str, max_bytes: int) -> None:
+        self.directory = os.path.join(CACHE_DIR, name)
+        self.max_bytes = max_bytes
+        self.entries: dict[str, tuple[int, float]] | None = None # key: (size, last access), loaded on first use
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f'{key}.{extension}')
+
+    def _load_entries(self) -> dict[str, tuple[int, float]]:
+        if self.entries is None:
+            os.makedirs(self.directory, exist_ok=True)
+
+            self.entries = {}
+
+            # the modified time of the body is used as the last access time
+            for entry in os.scandir(self.directory):
+                key, extension = os.path.splitext(entry.name)
+
+                if extension == '.body':
+                    stat = entry.stat()
+                    self.entries[key] = (stat.st_size, stat.st_mtime)
+
+            self.total_bytes = sum(size for size, _ in self.entries.values())
+
+        return self.entries
+
+    def _write(self, path: str, data: bytes) -> None:
+        temp_path = f'{path}.tmp'
+
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+
+        os.replace(temp_path, path)
+
+    def _remove(self, key: str) -> None:
+        entries = self._load_entries()
+
+        if key in entries:
+            self.total_bytes -= entries.pop(key)[0]
+
+        for extension in ('body', 'meta'):
+            try:
+                os.remove(self._path(key, extension))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> tuple[Metadata, bytes] | None:
+        '''
+        Returns the metadata and body saved under `key`, or `None` if there isn't anything.
+        '''
+
+        with self.lock:
+            entries = self._load_entries()
+
+            if key not in entries:
+                return None
+
+            try:
+                with open(self._path(key, 'meta')) as f:
+                    metadata = json.load(f)
+
+                with open(self._path(key, 'body'), 'rb') as f:
+                    body = f.read()
+
+            except (OSError, ValueError):
+                self._remove(key)
+
+                return None
+
+            # mark as recently used
+            now = time.time()
+            entries[key] = (len(body), now)
+            os.utime(self._path(key, 'body'), (now, now))
+
+            return metadata, body
+
+    def put(self, key: str, metadata: Metadata, body: bytes) -> None:
+        '''
+        Saves `body` and `metadata` under `key`, then deletes old entries if the cache is too big.
+        '''
+
+        with self.lock:
+            entries = self._load_entries()
+
+            if key in entries:
+                self.total_bytes -= entries[key][0]
+
+            self._write(self._path(key, 'meta'), json.dumps(metadata).encode())
+            self._write(self._path(key, 'body'), body)
+
+            entries[key] = (len(body), time.time())
+            self.total_bytes += len(body)
+
+            # evict the least recently used entries
+            if self.total_bytes > self.max_bytes:
+                for old_key, _ in sorted(entries.items(), key=lambda item: item[1][1]):
+                    if self.total_bytes <= self.max_bytes or old_key == key:
+                        break
+
+                    self._remove(old_key)
+
+    def update_metadata(self, key: str, metadata: Metadata) -> None:
+        '''
+        Replaces the metadata of an entry without rewriting its body.
+        '''
+
+        with self.lock:
+            if key in self._load_entries():
+                self._write(self._path(key, 'meta'), json.dumps(metadata).encode())
+
+    def clear(self) -> None:
+        with self.lock:
+            for key in list(self._load_entries()):
+                self._remove(key)
+
+
+
+class JsonCache:
+    '''
+    A small cache of json values saved to one file, where each entry expires after its own time to live.
+
+    Counts hits and misses. Safe to use from many threads at once.
+    '''
+
+    __slots__ = ('path', 'entries', 'hits', 'misses', 'lock')
+
+    def __init__(self, name: str) -> None:
+        self.path = os.path.join(CACHE_DIR, f'{name}.json')
+        self.entries: dict[str, tuple[float, Any]] | None = None # key: (expiry time, value), loaded on first use
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def _load_entries(self) -> dict[str, tuple[float, Any]]:
+        if self.entries is None:
+            try:
+                with open(self.path) as f:
+                    entries = json.load(f)
+
+            except (OSError, ValueError):
+                entries = {}
+
+            # drop anything that has already expired
+            now = time.time()
+            self.entries = {key: (expires, value) for key, (expires, value) in entries.items() if expires > now}
+
+        return self.entries
+
+    def _save(self) -> None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        temp_path = f'{self.path}.tmp'
+
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f)
+
+        os.replace(temp_path, self.path)
+
+    def get(self, key: str) -> Any:
+        '''
+        Returns the value saved under `key`, or `None` if there isn't one or it expired.
+        '''
+
+        with self.lock:
+            entry = self._load_entries().get(key)
+
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+
+                return None
+
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key: str, value: Any, ttl: float) -> None:
+        '''
+        Saves `value` under `key` for `ttl` seconds.
+        '''
+
+        with self.lock:
+            self._load_entries()[key] = (time.time() + ttl, value)
+
+            self._save()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries = {}
+
+            self._save()
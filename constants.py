@@ -1,12 +1,13 @@
 import os
 import sys
-from typing import Any
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any
 
-import tiktoken
-
-from exceptions import retry_on_connection_error
 from secret import * # sensitive information not included on github
 
+if TYPE_CHECKING:
+    import tiktoken
+
 
 
 # ui
@@ -42,6 +43,8 @@ ENTRY_COLORS: dict[str, Any] = {
     'background': ELEMENT_COLOR,
 }
 
+CITY_SUGGESTIONS = 6 # most cities listed under the city box while typing
+
 
 # directory paths
 if getattr(sys, 'frozen', False): # If the application is run as an exe
@@ -54,6 +57,70 @@ else: # If the application is run as a script (the 'data' folder is in a 'dist'
 
     DATA_DIR = os.path.join(ROOT_DIR, 'dist', 'data')
 
+TIKTOKEN_DIR = os.path.join(DATA_DIR, 'tiktoken') # tokenizer files, so the tokenizer loads without downloading anything
+
+
+# network
+MAX_CONNECTIONS_PER_HOST = 4
+POLITENESS_DELAY = 0.25 # seconds between the start of requests to the same host
+
+HOST_LIMITS: dict[str, tuple[int, float]] = { # host: (max connections, politeness delay)
+    'www.googleapis.com': (10, 0.0),
+}
+
+MAX_PAGE_BYTES = 2 * 1024 * 1024 # web pages are cut off after this many bytes
+
+
+# database
+DATABASE_BACKEND = 'sqlite' # 'sqlite' or 'json'
+
+
+# queries
+MERGE_TREATMENT_QUERIES = False # price all of a city's treatments with one search and GPT call instead of one each
+
+
+# massage
+MASSAGE_MAX_LISTINGS = 200 # most massagebook listings used for a zip code
+MASSAGE_MAX_PAGES = 10 # most result pages crawled for a zip code
+MASSAGE_CACHE_TTL = 7 * 24 * 60 * 60 # seconds a zip code's listings are kept
+MASSAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+# samples
+MAX_PRICE_PER_MINUTE = 12.5 # samples more expensive than this are left out of prices
+SAMPLE_FLUSH_EVERY = 500 # samples kept in memory before they're written to a new chunk file
+SAMPLE_TRIM = 0.1 # fraction of the lowest and highest samples the trimmed mean drops
+
+
+# estimation
+ESTIMATE_PRICES = False # estimate unsaved prices from nearby cities' saved prices before querying GPT
+ESTIMATE_RADIUS_MILES = 50.0
+ESTIMATE_NEIGHBORS = 10 # most nearby cities used in an estimate
+ESTIMATE_MIN_NEIGHBORS = 2
+ESTIMATE_MIN_CONFIDENCE = 0.6 # estimates less confident than this are replaced by a GPT query
+ESTIMATE_HALF_LIFE = 180 * 24 * 60 * 60 # seconds until a saved price counts half as much in an estimate
+
+
+# workers
+STAGE_WORKERS = { # number of threads for each stage of getting prices
+    'jobs': 8,
+    'search': 4,
+    'fetch': 16,
+    'llm': 4,
+}
+
+PARSE_PROCESSES = 0 # processes for parsing web pages, 0 parses them on the fetching threads instead
+
+
+# caching
+PAGE_CACHE_TTL = 24 * 60 * 60 # seconds before a cached page is revalidated
+PAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+SEARCH_CACHE_TTL = 7 * 24 * 60 * 60
+SEARCH_CACHE_FAILED_TTL = 60 * 60 # failed and empty searches are retried sooner
+
+COMPLETION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
 
 # search
 SEARCH_KEYWORDS = {
@@ -65,6 +132,12 @@ SEARCH_KEYWORDS = {
 }
 
 
+DUPLICATE_CHUNK_LINES = 5 # lines in each chunk compared between sources
+DUPLICATE_THRESHOLD = 0.8 # similarity above which a chunk counts as a copy of one in an earlier source
+
+SELECTION_CHUNK_LINES = 4 # lines in each chunk scored when picking what to send to GPT
+
+
 # messages
 SYSTEM_MESSAGE = {
     'role': 'system',
@@ -80,6 +153,10 @@ You can use your knowledge about the general cost of {} based on city size, and
 Don't include any prices that are more than $10 per minute.
 Give me at least 8, but less than 25 samples, and don't repeat any data points.
 '''[1:-1].replace('\n', ' ')
+CITY_PROMPT = '''
+I am trying to get price estimates for several treatments in {}, using the same sources for all of them.
+Answer each of the following separately, with one entry per treatment named exactly as it is listed:
+'''[1:-1].replace('\n', ' ')
 
 
 # model info
@@ -88,14 +165,25 @@ MODEL_TEMPERATURE = 0.3
 
 
 # token stuff
-@retry_on_connection_error()
-def get_4o_encoding() -> tiktoken.Encoding:
-    return tiktoken.encoding_for_model('gpt-4o')
+@lru_cache(maxsize=None)
+def get_encoding() -> 'tiktoken.Encoding':
+    '''
+    Returns the gpt-4o tokenizer, loading it the first time it's needed.
+
+    The tokenizer file is read from `TIKTOKEN_DIR`. It's only downloaded if it isn't there, and is saved there for next time.
+    '''
+
+    os.environ.setdefault('TIKTOKEN_CACHE_DIR', TIKTOKEN_DIR)
+
+    import tiktoken
+
+    from exceptions import retry_on_connection_error
 
-GPT_ENCODING = get_4o_encoding()
+    return retry_on_connection_error()(tiktoken.encoding_for_model)('gpt-4o')
 
 MAX_INPUT_TOKENS_PER_QUERY = 12_500
 MAX_OUTPUT_TOKENS_PER_QUERY = 1_000
+MESSAGE_TOKEN_OVERHEAD = 8 # tokens per message for its role, formatting and the source header
 
 MAX_TOKENS_PER_MINUTE = 40_000
 
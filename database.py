@@ -1,30 +1,178 @@
 '''
-Module for accessing and saving to the database file of saved search data
+Module for accessing and saving to the database of saved search data
+
+There are two backends: the original json file, which is rewritten on every save, and a SQLite database that saves each price as it is set.
 '''
 
 import json
 import os
+import sqlite3
+import time
+from threading import Lock
 
-from constants import DATA_DIR
+from constants import DATA_DIR, DATABASE_BACKEND
 
 
 
 DATABASE_PATH = os.path.join(DATA_DIR, 'search_save_data.json')
+SQLITE_DATABASE_PATH = os.path.join(DATA_DIR, 'search_save_data.sqlite3')
 
 PricingData = dict[str, float]
-Database = dict[str, PricingData]
 
 
 
-def load() -> dict[str, PricingData]:
-    with open(DATABASE_PATH) as f:
-        data = json.loads(f.read())
+class JsonDatabase:
+    '''
+    Prices kept in memory and written to a json file when saved.
+    '''
+
+    __slots__ = ('path', 'data', 'lock')
+
+    def __init__(self, path: str = DATABASE_PATH) -> None:
+        self.path = path
+        self.lock = Lock()
+
+        with open(path) as f:
+            self.data: dict[str, PricingData] = json.loads(f.read())
+
+    def get_pricing(self, city: str) -> PricingData:
+        with self.lock:
+            return dict(self.data.get(city, {}))
+
+    def get_price(self, city: str, treatment: str) -> float | None:
+        with self.lock:
+            return self.data.get(city, {}).get(treatment)
+
+    def set_price(self, city: str, treatment: str, price_per_minute: float) -> None:
+        with self.lock:
+            if city not in self.data:
+                self.data[city] = {}
+
+            self.data[city][treatment] = price_per_minute
+
+    def get_treatment_prices(self, treatment: str) -> dict[str, tuple[float, float | None]]:
+        '''
+        Returns the price of `treatment` in every city it's saved for. The json database doesn't keep when prices were saved, so the times are `None`.
+        '''
+
+        with self.lock:
+            return {city: (pricing[treatment], None) for city, pricing in self.data.items() if treatment in pricing}
+
+    def cities(self) -> list[str]:
+        with self.lock:
+            return list(self.data)
+
+    def save(self) -> None:
+        with self.lock:
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(self.data, indent=4))
+
+
+
+class SqliteDatabase:
+    '''
+    Prices kept in a SQLite database in WAL mode, with one row for each city and treatment.
+
+    Every `set_price` is committed straight away, so `save` has nothing to do.
+
+    If the database is new, the prices in the json database are imported into it. The json database doesn't keep when prices were saved, so imported prices are saved with an `updated` of 0, meaning unknown.
+    '''
+
+    __slots__ = ('path', 'connection', 'lock')
+
+    def __init__(self, path: str = SQLITE_DATABASE_PATH, json_path: str = DATABASE_PATH) -> None:
+        self.path = path
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS prices (
+                    city TEXT NOT NULL,
+                    treatment TEXT NOT NULL,
+                    price_per_minute REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (city, treatment)
+                )
+            ''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS prices_by_treatment ON prices (treatment)')
+
+        if self._is_empty() and os.path.exists(json_path):
+            self.import_json(json_path)
+
+    def _is_empty(self) -> bool:
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM prices LIMIT 1').fetchone() is None
+
+    def import_json(self, json_path: str) -> None:
+        '''
+        Adds every price in a json database, keeping any prices that are already saved.
+        '''
+
+        with open(json_path) as f:
+            data: dict[str, PricingData] = json.loads(f.read())
+
+        rows = [(city, treatment, price, 0.0) for city, pricing in data.items() for treatment, price in pricing.items()]
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO prices VALUES (?, ?, ?, ?)', rows)
+
+    def get_pricing(self, city: str) -> PricingData:
+        with self.lock:
+            rows = self.connection.execute('SELECT treatment, price_per_minute FROM prices WHERE city = ?', (city,)).fetchall()
+
+        return dict(rows)
+
+    def get_price(self, city: str, treatment: str) -> float | None:
+        with self.lock:
+            row = self.connection.execute('SELECT price_per_minute FROM prices WHERE city = ? AND treatment = ?', (city, treatment)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set_price(self, city: str, treatment: str, price_per_minute: float) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('''
+                INSERT INTO prices VALUES (?, ?, ?, ?)
+                ON CONFLICT (city, treatment) DO UPDATE SET price_per_minute = excluded.price_per_minute, updated = excluded.updated
+            ''', (city, treatment, price_per_minute, time.time()))
+
+    def get_treatment_prices(self, treatment: str) -> dict[str, tuple[float, float | None]]:
+        '''
+        Returns the price of `treatment` in every city it's saved for, along with when it was saved (`None` for prices imported from the json database).
+        '''
+
+        with self.lock:
+            rows = self.connection.execute('SELECT city, price_per_minute, updated FROM prices WHERE treatment = ?', (treatment,)).fetchall()
+
+        return {city: (price, updated or None) for city, price, updated in rows}
+
+    def cities(self) -> list[str]:
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT city FROM prices').fetchall()
+
+        return [city for city, in rows]
+
+    def save(self) -> None:
+        pass
+
+
 
-    return data
+Database = JsonDatabase | SqliteDatabase
 
 
 
-def save(database: dict[str, PricingData]) -> None:
-    with open(DATABASE_PATH, 'w') as f:
-        f.write(json.dumps(database, indent=4))
+def load(backend: str = DATABASE_BACKEND) -> Database:
+    '''
+    Opens the database using `backend`, either 'sqlite' or 'json'.
+    '''
 
+    match backend:
+        case 'sqlite':
+            return SqliteDatabase()
+        case 'json':
+            return JsonDatabase()
+        case _:
+            raise ValueError(f'Unknown database backend "{backend}"')
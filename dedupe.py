@@ -0,0 +1,60 @@
+'''
+Module for removing near duplicate text that shows up in more than one source, like a chain's price list copied across its locations' pages
+'''
+
+import re
+
+from constants import DUPLICATE_CHUNK_LINES, DUPLICATE_THRESHOLD
+from document import Document
+
+
+
+SHINGLE_SIZE = 3 # words in each shingle
+MIN_SHINGLES = 3 # chunks with fewer shingles than this are too short to call duplicates
+
+_WORD = re.compile(r'[a-z0-9$.]+')
+
+
+
+def shingles(text: str) -> set[int]:
+    '''
+    Returns the hashes of every run of `SHINGLE_SIZE` words in `text`, ignoring case and punctuation.
+    '''
+
+    words = _WORD.findall(text.lower())
+
+    return {hash(tuple(words[i:i + SHINGLE_SIZE])) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+
+def remove_near_duplicates(documents: list[Document], threshold: float = DUPLICATE_THRESHOLD) -> list[Document]:
+    '''
+    Removes chunks of `DUPLICATE_CHUNK_LINES` lines when at least `threshold` of their shingles are already in earlier documents.
+
+    Comparing against every shingle seen so far (instead of chunk to chunk) still catches copies that start on a different line.
+
+    The earliest copy is always the one kept, so higher ranked sources win. Documents are returned in the same order, and are dropped if nothing is left of them.
+    '''
+
+    seen: set[int] = set()
+    output: list[Document] = []
+
+    for document in documents:
+        keep: list[int] = []
+
+        for start in range(0, len(document.lines), DUPLICATE_CHUNK_LINES):
+            indices = range(start, min(start + DUPLICATE_CHUNK_LINES, len(document.lines)))
+            chunk_shingles = shingles(''.join(document.lines[i] for i in indices))
+
+            if len(chunk_shingles) >= MIN_SHINGLES and len(chunk_shingles & seen) >= threshold * len(chunk_shingles):
+                continue
+
+            keep.extend(indices)
+
+        # only add this document's shingles once it's done, so it isn't compared against itself
+        seen.update(shingles(document.text))
+
+        if keep:
+            output.append(document if len(keep) == len(document.lines) else document.select(keep))
+
+    return output
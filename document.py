@@ -0,0 +1,74 @@
+'''
+Module containing a tokenized document, so text scraped from a website only has to be encoded once
+'''
+
+from array import array
+from dataclasses import dataclass, field
+from itertools import accumulate
+
+
+
+PackedDocument = tuple[str, str, bytes, bytes, bytes]
+
+
+
+@dataclass(slots=True)
+class Document:
+    '''
+    Text split into lines (each keeping its line ending), along with the token ids of each line.
+
+    The token count is the sum of the tokens of each line, which can be slightly more than encoding the whole text at once.
+    '''
+
+    lines: list[str]
+    line_tokens: list[list[int]]
+    url: str = ''
+    token_count: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.token_count = sum(map(len, self.line_tokens))
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.lines)
+
+    @property
+    def tokens(self) -> list[int]:
+        return [token for tokens in self.line_tokens for token in tokens]
+
+    def select(self, indices: list[int]) -> 'Document':
+        '''
+        Returns a document of only the lines at `indices`.
+        '''
+
+        return Document([self.lines[i] for i in indices], [self.line_tokens[i] for i in indices], self.url)
+
+    def pack(self) -> PackedDocument:
+        '''
+        Returns the document as a few flat strings and byte arrays, which are much quicker to pickle than lists of lists.
+        '''
+
+        return (
+            self.url,
+            self.text,
+            array('I', map(len, self.lines)).tobytes(),
+            array('I', map(len, self.line_tokens)).tobytes(),
+            array('I', self.tokens).tobytes(),
+        )
+
+    @classmethod
+    def unpack(cls, packed: PackedDocument) -> 'Document':
+        '''
+        Rebuilds a document from `pack()`.
+        '''
+
+        url, text, line_lengths, line_token_counts, tokens = packed
+
+        line_ends = list(accumulate(array('I', line_lengths)))
+        token_ends = list(accumulate(array('I', line_token_counts)))
+        token_list = array('I', tokens).tolist()
+
+        lines = [text[start:end] for start, end in zip([0] + line_ends, line_ends)]
+        line_tokens = [token_list[start:end] for start, end in zip([0] + token_ends, token_ends)]
+
+        return cls(lines, line_tokens, url)
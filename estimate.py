@@ -0,0 +1,127 @@
+'''
+Module for estimating a treatment's price in a city from the saved prices of the cities around it, so not every city needs its own search and GPT query
+'''
+
+from dataclasses import dataclass
+import math
+import time
+
+from constants import ESTIMATE_HALF_LIFE, ESTIMATE_MIN_NEIGHBORS, ESTIMATE_NEIGHBORS, ESTIMATE_RADIUS_MILES
+from zipcode import Zipcode, get_zip_index
+
+
+
+MIN_DISTANCE = 2.0 # miles, so a city right next door doesn't get all of the weight
+
+
+
+@dataclass(slots=True, frozen=True)
+class Estimate:
+    '''
+    An estimated price per minute, and how much to trust it from 0 to 1.
+
+    `neighbors` are the cities the estimate was made from, with their distance in miles.
+    '''
+
+    price_per_minute: float
+    confidence: float
+    neighbors: dict[str, float]
+
+
+
+def _city_key(city: str) -> str:
+    '''
+    Returns `city` (as `'City, ST'`) in a form that matches however it was capitalized or spaced.
+    '''
+
+    return ', '.join(' '.join(part.split()) for part in city.split(',')).casefold()
+
+
+
+def _city_size(city: str) -> int:
+    name, state = _city_key(city).split(', ')
+
+    return get_zip_index().city_size(name, state)
+
+
+
+def estimate_price(
+        city: str,
+        saved_prices: dict[str, tuple[float, float | None]],
+        radius: float = ESTIMATE_RADIUS_MILES,
+        weight_by_size: bool = True,
+    ) -> Estimate | None:
+
+    '''
+    Estimates the price per minute in `city` from the `saved_prices` (city: (price per minute, time saved)) of up to `ESTIMATE_NEIGHBORS` cities within `radius` miles.
+
+    Each city's price is weighted by the inverse square of its distance, and halves in weight every `ESTIMATE_HALF_LIFE` seconds since it was saved.
+    If `weight_by_size` is set, cities with a similar number of zip codes (a rough stand in for population) also count for more.
+
+    The confidence is higher with more neighbors, closer neighbors and neighbors that agree with each other.
+
+    Prices of 0 or less are left out, since they're saved when a query fails or none of its samples could be used.
+
+    Returns `None` if `city` isn't a known city or there are fewer than `ESTIMATE_MIN_NEIGHBORS` priced cities nearby.
+    '''
+
+    try:
+        center = Zipcode.from_city(city)
+    except ValueError:
+        return None
+
+    # saved names aren't always written the same way as the zip code dataset's
+    saved_names = {_city_key(name): name for name, (price, _) in saved_prices.items() if price > 0}
+    city_key = _city_key(city)
+
+    neighbors: dict[str, float] = {}
+
+    for neighbor, distance in center.cities_within(radius).items():
+        neighbor_key = _city_key(neighbor)
+
+        if neighbor_key != city_key and neighbor_key in saved_names:
+            neighbors[saved_names[neighbor_key]] = distance
+
+            if len(neighbors) == ESTIMATE_NEIGHBORS:
+                break
+
+    if len(neighbors) < ESTIMATE_MIN_NEIGHBORS:
+        return None
+
+    now = time.time()
+    size = _city_size(city)
+
+    prices: list[float] = []
+    weights: list[float] = []
+
+    for neighbor, distance in neighbors.items():
+        price, updated = saved_prices[neighbor]
+
+        weight = 1 / (distance + MIN_DISTANCE) ** 2
+
+        if updated is not None:
+            weight *= 0.5 ** (max(0.0, now - updated) / ESTIMATE_HALF_LIFE)
+
+        if weight_by_size:
+            neighbor_size = _city_size(neighbor)
+
+            weight *= min(size, neighbor_size) / max(size, neighbor_size, 1)
+
+        prices.append(price)
+        weights.append(weight)
+
+    total_weight = sum(weights)
+
+    if total_weight <= 0:
+        return None
+
+    mean = sum(price * weight for price, weight in zip(prices, weights)) / total_weight
+
+    # how much the neighbors disagree, relative to the estimate
+    spread = math.sqrt(sum(weight * (price - mean) ** 2 for price, weight in zip(prices, weights)) / total_weight) / mean if mean else 1.0
+
+    coverage = len(neighbors) / (len(neighbors) + 1)
+    agreement = max(0.0, 1 - spread)
+    proximity = sum(weight * (1 - distance / radius) for distance, weight in zip(neighbors.values(), weights)) / total_weight
+
+    return Estimate(mean, coverage * agreement * proximity, neighbors)
@@ -4,16 +4,54 @@ Module containing decorators for handling exceptions and retrying functions.
 
 
 import time
-from functools import partial
-from tkinter import messagebox
 from typing import Any, Callable, Optional, Type
 
-import requests.exceptions
-
 
 
 RetryPrompt = tuple[str, str]
 
+_headless = False
+
+
+
+def set_headless(headless: bool) -> None:
+    '''
+    Turns tkinter prompts on or off.
+
+    When headless, retry prompts always retry and terminal prompts are logged instead of shown, so tkinter is never imported.
+    '''
+
+    global _headless
+
+    _headless = headless
+
+
+
+def show_prompt(prompt: RetryPrompt, type: str) -> str:
+    '''
+    Opens a tkinter messagebox of `type` with the title and message from `prompt` and returns the button that was pressed.
+
+    Returns the default answer without opening anything when running headless.
+    '''
+
+    if _headless:
+        from log import log
+
+        log(f'{prompt[0]}: {prompt[1]}\n', 'errors.txt')
+
+        return 'retry' if type == 'retrycancel' else 'ok'
+
+    from tkinter import messagebox
+
+    window = messagebox.Message(
+        icon='error',
+        type=type,
+        title=prompt[0],
+        message=prompt[1]
+    )
+
+    return window.show()
+
 
 
 def retry_on_exception(
@@ -40,22 +78,6 @@ def retry_on_exception(
     If `terminal_prompt` is specified, it will open a tkinter "ok" messagebox when it runs out of retries with the title and message being the two items of the tuple.
     '''
 
-    if retry_prompt is not None:
-        window = messagebox.Message(
-            icon='error',
-            type='retrycancel',
-            title=retry_prompt[0],
-            message=retry_prompt[1]
-        )
-
-    if terminal_prompt:
-        terminal_window = messagebox.Message(
-            icon='error',
-            type='ok',
-            title=terminal_prompt[0],
-            message=terminal_prompt[1]
-        )
-
     def decorator(func: Callable[..., Any]):
         def wrapper(*args, **kwargs):
             for attempt in range(max_retries + 1):
@@ -65,7 +87,7 @@ def retry_on_exception(
                 except exception_types as exception:
                     if attempt == max_retries:
                         if terminal_prompt:
-                            terminal_window.show()
+                            show_prompt(terminal_prompt, 'ok')
 
                         if default_value is not None:
                             return default_value
@@ -73,7 +95,7 @@ def retry_on_exception(
                         raise exception
 
                     elif retry_prompt is not None:
-                        match window.show():
+                        match show_prompt(retry_prompt, 'retrycancel'):
                             case 'retry':
                                 pass
                             case 'cancel':
@@ -93,7 +115,7 @@ def retry_on_exception(
 def retry_on_connection_error(
         max_retries: int = 1,
         default_value: Any = None,
-    ) -> Callable: # type: ignore
+    ) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
 
     '''
     Retries a function when it raises a requests connection or timeout error.
@@ -101,20 +123,35 @@ def retry_on_connection_error(
     Retries the function `max_retries` times.
 
     If `default_value` is specified, it will return that value if it runs out of retries. Raises the final exception otherwise.
+
+    `requests` is only imported the first time the function is called, so decorating functions with this doesn't slow down startup.
     '''
 
-    pass
-
-retry_on_connection_error = partial(
-    retry_on_exception,
-    requests.exceptions.ConnectionError, requests.exceptions.Timeout,
-    retry_prompt=(
-        'Connection Error',
-        'There was an error when trying to connect to the internet.\nPlease check your internet and try again.'
-    ),
-    terminal_prompt=(
-        'Connection Failed',
-        'Operation Cancelled.\nFailed when trying to connect to the internet.\nPlease check your internet and try again.'
-    ),
-) # type: ignore
+    def decorator(func: Callable[..., Any]):
+        retrying: Optional[Callable[..., Any]] = None
+
+        def wrapper(*args, **kwargs):
+            nonlocal retrying
+
+            if retrying is None:
+                import requests.exceptions
+
+                retrying = retry_on_exception(
+                    requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    max_retries=max_retries,
+                    default_value=default_value,
+                    retry_prompt=(
+                        'Connection Error',
+                        'There was an error when trying to connect to the internet.\nPlease check your internet and try again.'
+                    ),
+                    terminal_prompt=(
+                        'Connection Failed',
+                        'Operation Cancelled.\nFailed when trying to connect to the internet.\nPlease check your internet and try again.'
+                    ),
+                )(func)
+
+            return retrying(*args, **kwargs)
 
+        return wrapper
+
+    return decorator
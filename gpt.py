@@ -2,22 +2,40 @@
 Module for querying OpenAI's GPT-4o model to parse through data and extract pricing information.
 '''
 
-from typing import Sequence, Optional
+import json
+import os
+import re
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Generic, Sequence, Optional, TypeVar
 
 import openai
 from openai import RateLimitError
 from openai.types.chat.parsed_chat_completion import ParsedChatCompletion
 from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
 import web_scraper
+from cache import DiskCache, hash_key
 from constants import *
+from document import Document
 from exceptions import retry_on_exception, retry_on_connection_error
 from log import log
+from rate_limit import OPENAI_RATE_LIMITER
+from samples import SampleRow, SampleStore
+from scheduler import get_stage
 from treatments import Treatment
 
 
 
+_SOURCE_NUMBER = re.compile(r'\bsource\s*#?\s*(\d+)', re.IGNORECASE)
+
+
+
 class Sample(BaseModel):
     provider: Optional[str] = Field(description='The company that provides the treatment. Can be either the name/number of the source or the name of the company in a source. Should be "GPT" if the treatment isn\'t from a source, but from general knowledge of prices in the area.')
     duration: float = Field(description='The length of the treatment in minutes.')
@@ -32,81 +50,641 @@ class TreatmentPrices(BaseModel):
 
     def get_pricing(self) -> float:
         '''
-        Returns the average price per minute of the samples
+        Returns the average price per minute of the samples, leaving out ones without a duration or package count, or over `MAX_PRICE_PER_MINUTE`.
+
+        Returns 0 if there aren't any samples left.
         '''
 
         total = 0.0
+        count = 0
 
         for treatment in self.samples:
             if treatment.duration and treatment.package_count:
                 ppm = (treatment.cost / treatment.duration / treatment.package_count)
 
-                if ppm <= 12.5:
+                if ppm <= MAX_PRICE_PER_MINUTE:
                     total += ppm
+                    count += 1
 
-        average = total / len(self.samples)
+        if not count:
+            return 0.0
+
+        average = total / count
 
         return average
 
+    def sample_rows(self, source_urls: list[str]) -> list[SampleRow]:
+        '''
+        Returns the samples as rows for a `SampleStore`.
+
+        The source of a sample is the url of the source its provider names ("Source 2"), or the only source if there was just one.
+        '''
+
+        rows: list[SampleRow] = []
+
+        for sample in self.samples:
+            provider = sample.provider or ''
+            source = ''
+
+            if (match := _SOURCE_NUMBER.search(provider)) and int(match.group(1)) < len(source_urls):
+                source = source_urls[int(match.group(1))]
+
+            elif len(source_urls) == 1:
+                source = source_urls[0]
+
+            rows.append((provider, sample.duration, sample.cost, sample.package_count, source))
+
+        return rows
+
+
+
+class CityPrices(BaseModel):
+    treatments: list[TreatmentPrices] = Field(description='The samples for each treatment, with one entry per treatment.')
+
+
+
+Reply = TypeVar('Reply', bound=BaseModel)
+
+
+
+@dataclass(slots=True, frozen=True)
+class Completion(Generic[Reply]):
+    reply: Reply | None
+    prompt_tokens: int
+    completion_tokens: int
+    cached: bool
+
+    @property
+    def cost(self) -> float:
+        return self.prompt_tokens * COST_PER_INPUT_TOKEN + self.completion_tokens * COST_PER_OUTPUT_TOKEN
+
+
+
+COMPLETION_CACHE = DiskCache('completions', COMPLETION_CACHE_MAX_BYTES)
+
+BATCH_DIR = os.path.join(DATA_DIR, 'batches')
+
+BatchKey = tuple[str, str] # (city, treatment name)
+
+
+
+@lru_cache
+def _response_schema(response_format: type[BaseModel]) -> str:
+    return json.dumps(response_format.model_json_schema(), sort_keys=True)
+
+
+
+def completion_key(messages: Sequence[ChatCompletionMessageParam], response_format: type[BaseModel] = TreatmentPrices, max_output_tokens: int = MAX_OUTPUT_TOKENS_PER_QUERY) -> str:
+    '''
+    Returns the completion cache key of `messages` with the current model settings.
+    '''
+
+    return hash_key(MODEL_NAME, str(MODEL_TEMPERATURE), str(max_output_tokens), _response_schema(response_format), json.dumps(messages, sort_keys=True))
+
+
+
+def log_completion(completion: Completion) -> None:
+    if completion.reply is None:
+        return
+
+    if completion.cached:
+        log(f'Query cost: $0.000 (cached, saved ${completion.cost:.3f})\n{completion.reply.model_dump_json(indent=2)}\n\n', 'gpt_responses.txt')
+
+    else:
+        log(f'Query cost: ${completion.cost:.3f}\n{completion.reply.model_dump_json(indent=2)}\n\n', 'gpt_responses.txt')
+
 
 
 class GPT:
-    __slots__ = ('client')
+    __slots__ = ('client', 'samples')
+
+    def __init__(self, samples: SampleStore | None = None) -> None:
+        '''
+        If `samples` is given, the samples of every new reply are saved to it.
+        '''
 
-    def __init__(self) -> None:
         self.client=openai.OpenAI(api_key=OPENAI_API_KEY)
+        self.samples = samples
+
+    def get_completion(
+            self,
+            messages: Sequence[ChatCompletionMessageParam],
+            prompt_tokens: int | None = None,
+            response_format: type[Reply] = TreatmentPrices, # type: ignore
+            max_output_tokens: int = MAX_OUTPUT_TOKENS_PER_QUERY,
+        ) -> Completion[Reply]:
+
+        '''
+        Returns GPT's reply to `messages`, parsed as `response_format`.
+
+        `prompt_tokens` is the number of tokens in `messages` if it is already known, otherwise they are counted when needed.
+
+        Replies are cached on disk by a hash of the model settings, response schema and messages, so identical queries are free.
+        '''
+
+        key = completion_key(messages, response_format, max_output_tokens)
+        cached = COMPLETION_CACHE.get(key)
+
+        if cached is not None:
+            usage, body = cached
+
+            return Completion(response_format.model_validate_json(body), usage['prompt_tokens'], usage['completion_tokens'], True)
+
+        completion = get_stage('llm').run(self.request_completion, messages, prompt_tokens, response_format, max_output_tokens)
+
+        reply = completion.choices[0].message.parsed
+        usage = completion.usage
+
+        # only cache replies that parsed, so failures get retried next time
+        if reply is not None and usage is not None:
+            COMPLETION_CACHE.put(
+                key,
+                {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens},
+                reply.model_dump_json().encode()
+            )
+
+        if usage is None:
+            return Completion(reply, 0, 0, False)
+
+        return Completion(reply, usage.prompt_tokens, usage.completion_tokens, False)
 
     @retry_on_exception(
         RateLimitError,
-        max_retries=60,
+        max_retries=8,
         retry_after=5,
-        retry_after_exponent=1.75
+        retry_after_exponent=1.5
     )
-    def get_completion(self, messages: Sequence[ChatCompletionMessageParam]) -> ParsedChatCompletion[TreatmentPrices]:
-        completion = self.client.beta.chat.completions.parse(
-            model = MODEL_NAME,
-            messages = messages,
-            response_format=TreatmentPrices,
-            n = 1,
-            temperature = MODEL_TEMPERATURE,
-            max_tokens = MAX_OUTPUT_TOKENS_PER_QUERY,
-        )
+    def request_completion(
+            self,
+            messages: Sequence[ChatCompletionMessageParam],
+            prompt_tokens: int | None = None,
+            response_format: type[Reply] = TreatmentPrices, # type: ignore
+            max_output_tokens: int = MAX_OUTPUT_TOKENS_PER_QUERY,
+        ) -> ParsedChatCompletion[Reply]:
+
+        '''
+        Sends `messages` to GPT once the shared rate limiter has room for them.
+        '''
+
+        if prompt_tokens is None:
+            prompt_tokens = messages_token_count(messages)
+
+        estimated_tokens = prompt_tokens + max_output_tokens
+
+        OPENAI_RATE_LIMITER.acquire(estimated_tokens)
+
+        try:
+            completion = self.client.beta.chat.completions.parse(
+                model = MODEL_NAME,
+                messages = messages,
+                response_format=response_format,
+                n = 1,
+                temperature = MODEL_TEMPERATURE,
+                max_tokens = max_output_tokens,
+            )
+
+        except RateLimitError:
+            # keep the tokens taken so the other threads slow down too
+            raise
+
+        except Exception:
+            OPENAI_RATE_LIMITER.settle(estimated_tokens, 0)
+
+            raise
+
+        if completion.usage is not None:
+            OPENAI_RATE_LIMITER.settle(estimated_tokens, completion.usage.total_tokens)
 
         return completion
 
+    def get_treatment_sources(self, city: str, treatment: Treatment) -> list[Document]:
+        keywords = SEARCH_KEYWORDS | treatment.keywords
+
+        return web_scraper.get_search_data(f'{treatment.name} "pricing" {city}', keywords, 8)
+
+    def record_samples(self, city: str, treatment_name: str, reply: TreatmentPrices, sources: list[Document]) -> None:
+        '''
+        Saves the samples of a new reply, if there is somewhere to save them.
+        '''
+
+        if self.samples is not None:
+            self.samples.add(city, treatment_name, reply.sample_rows([source.url for source in sources]))
+
+    def get_city_sources(self, city: str, treatments: list[Treatment]) -> list[Document]:
+        '''
+        Runs one search for all of `treatments` in `city`, and returns the sources with the keywords of every treatment.
+        '''
+
+        keywords = SEARCH_KEYWORDS.copy()
+
+        for treatment in treatments:
+            keywords |= treatment.keywords
+
+        names = ' OR '.join(f'"{treatment.name}"' for treatment in treatments)
+
+        return web_scraper.get_search_data(f'({names}) "pricing" {city}', keywords, 8)
+
     @retry_on_connection_error(default_value=0.0)
     def query_treatment_pricing(self, city: str, treatment: Treatment) -> float:
-        keywords = SEARCH_KEYWORDS | treatment.keywords
+        sources = self.get_treatment_sources(city, treatment)
+        query = assemble_messages(sources, treatment.get_prompt(city))
+
+        if query is None:
+            return 0.0
+
+        completion = self.get_completion(*query)
+
+        log_completion(completion)
+
+        if completion.reply is None:
+            return 0.0
+
+        # cached replies were saved when they were new
+        if not completion.cached:
+            self.record_samples(city, treatment.name, completion.reply, sources)
+
+        price_per_minute = completion.reply.get_pricing()
+
+        return price_per_minute
+
+    @retry_on_connection_error(default_value={})
+    def query_city_pricing(self, city: str, treatments: list[Treatment], single_call: bool = True) -> dict[str, float]:
+        '''
+        Gets the price per minute of every treatment in `city` from one shared search and set of sources.
+
+        If `single_call` is set, GPT is asked about every treatment at once and replies with a `CityPrices`.
+        Otherwise there is one query per treatment, all using the same sources.
+
+        Treatments without a reply are left out.
+        '''
+
+        sources = self.get_city_sources(city, treatments)
+
+        if single_call:
+            prompt = CITY_PROMPT.format(city) + '\n' + '\n'.join(f'- {treatment.name}: {treatment.get_prompt(city)}' for treatment in treatments)
+
+            query = assemble_messages(sources, prompt)
+
+            if query is None:
+                return {}
+
+            completion = self.get_completion(*query, CityPrices, MAX_OUTPUT_TOKENS_PER_QUERY * len(treatments))
+
+            log_completion(completion)
+
+            if completion.reply is None:
+                return {}
+
+            # match the replies up with the treatments by name
+            replies = {reply.treatment.lower(): reply for reply in completion.reply.treatments}
+
+            prices: dict[str, float] = {}
+
+            for treatment in treatments:
+                reply = replies.get(treatment.name.lower())
+
+                if reply is not None:
+                    prices[treatment.name] = reply.get_pricing()
 
-        sources = web_scraper.get_search_data(f'{treatment.name} "pricing" {city}', keywords, 8)
+                    if not completion.cached:
+                        self.record_samples(city, treatment.name, reply, sources)
 
-        tokens = sum(map(token_count, sources))
+            return prices
 
-        if tokens <= MAX_INPUT_TOKENS_PER_QUERY:
-            source_messages = [{'role': 'user', 'content': f'## Source {i}:\n\n{source}'} for i, source in enumerate(sources)]
+        queries = {treatment.name: assemble_messages(sources, treatment.get_prompt(city)) for treatment in treatments}
+        queries = {name: query for name, query in queries.items() if query is not None}
 
-            messages = [SYSTEM_MESSAGE] + source_messages + [{'role': 'user', 'content': treatment.get_prompt(city)}]
+        if not queries:
+            return {}
 
-            completion = self.get_completion(messages) # type: ignore
+        # these threads only wait, the llm stage limits how many queries are sent at once
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            completions = dict(zip(queries, executor.map(lambda query: self.get_completion(*query), queries.values())))
 
-            reply = completion.choices[0].message.parsed
+        prices: dict[str, float] = {}
 
-            if reply is None:
-                return 0.0
+        for name, completion in completions.items():
+            log_completion(completion)
 
-            tokens = completion.usage
-            query_cost = tokens.prompt_tokens * COST_PER_INPUT_TOKEN + tokens.completion_tokens * COST_PER_OUTPUT_TOKEN # type: ignore
+            if completion.reply is not None:
+                prices[name] = completion.reply.get_pricing()
 
-            log(f'Query cost: ${query_cost:.3f}\n{reply.model_dump_json(indent=2)}\n\n', 'gpt_responses.txt')
+                if not completion.cached:
+                    self.record_samples(city, name, completion.reply, sources)
 
-            price_per_minute = reply.get_pricing()
+        return prices
 
-            return price_per_minute
+    def send_request_body(self, body: dict[str, Any]) -> dict[str, Any]:
+        '''
+        Sends one batch request body straight to the chat completions endpoint and returns the response body.
+
+        Used by `LocalBatchBackend` to stand in for the batch API.
+        '''
+
+        return self.client.chat.completions.create(**body).model_dump()
+
+
+
+def assemble_messages(sources: list[Document], prompt: str) -> tuple[list[ChatCompletionMessageParam], int] | None:
+    '''
+    Returns the messages with each source and then `prompt`, along with their token count.
+
+    Returns `None` if the sources are too long to send.
+    '''
+
+    # the sources were tokenized when they were scraped, so only their counts are needed here
+    tokens = sum(source.token_count for source in sources)
+
+    if tokens > MAX_INPUT_TOKENS_PER_QUERY:
+        return None
+
+    source_messages = [{'role': 'user', 'content': f'## Source {i}:\n\n{source.text}'} for i, source in enumerate(sources)]
+
+    messages = [SYSTEM_MESSAGE] + source_messages + [{'role': 'user', 'content': prompt}]
+
+    prompt_tokens = tokens + token_count(SYSTEM_MESSAGE['content']) + token_count(prompt) + MESSAGE_TOKEN_OVERHEAD * len(messages)
+
+    return messages, prompt_tokens # type: ignore
+
+
+
+def _strict_schema(schema: Any) -> Any:
+    '''
+    Returns a copy of a json schema in the strict form structured outputs need: every object lists all of its properties as required and allows no others.
+    '''
+
+    if isinstance(schema, list):
+        return [_strict_schema(item) for item in schema]
+
+    if not isinstance(schema, dict):
+        return schema
+
+    strict = {key: _strict_schema(value) for key, value in schema.items()}
+
+    if strict.get('type') == 'object':
+        strict['additionalProperties'] = False
+        strict['required'] = list(strict.get('properties', {}))
+
+    # optional fields are required but nullable instead
+    if 'default' in strict and strict['default'] is None:
+        del strict['default']
+
+    return strict
+
+
+
+@lru_cache
+def response_format_param(response_format: type[BaseModel]) -> dict[str, Any]:
+    '''
+    Returns the `response_format` request parameter that makes GPT reply with `response_format`, the same as the SDK's `parse` sends.
+    '''
+
+    return {
+        'type': 'json_schema',
+        'json_schema': {
+            'schema': _strict_schema(response_format.model_json_schema()),
+            'name': response_format.__name__,
+            'strict': True,
+        },
+    }
+
+
+
+def completion_request_body(messages: Sequence[ChatCompletionMessageParam]) -> dict[str, Any]:
+    '''
+    Returns the body of a chat completions request for `messages`, with the same settings as `GPT.request_completion`.
+    '''
+
+    return {
+        'model': MODEL_NAME,
+        'messages': list(messages),
+        'response_format': response_format_param(TreatmentPrices),
+        'n': 1,
+        'temperature': MODEL_TEMPERATURE,
+        'max_tokens': MAX_OUTPUT_TOKENS_PER_QUERY,
+    }
+
+
+
+class BatchBackend(ABC):
+    '''
+    Somewhere to send a JSONL file of chat completion requests to be answered all at once.
+    '''
+
+    @abstractmethod
+    def submit(self, requests_path: str) -> str:
+        '''
+        Submits the requests in `requests_path` and returns the id of the batch.
+        '''
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        '''
+        Returns the status of a batch: 'completed', 'failed', 'expired', 'cancelled', or anything else while it is still running.
+        '''
+
+    @abstractmethod
+    def results(self, batch_id: str) -> list[dict[str, Any]]:
+        '''
+        Returns the output lines of a completed batch.
+        '''
+
+
+
+class OpenAIBatchBackend(BatchBackend):
+    '''
+    OpenAI's batch API. Batches finish within 24 hours.
+    '''
+
+    def __init__(self, client: openai.OpenAI) -> None:
+        self.client = client
+
+    def submit(self, requests_path: str) -> str:
+        with open(requests_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h',
+        )
+
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> list[dict[str, Any]]:
+        output_file_id = self.client.batches.retrieve(batch_id).output_file_id
+
+        if output_file_id is None:
+            return []
+
+        content = self.client.files.content(output_file_id).text
 
-        return 0.0
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+
+class LocalBatchBackend(BatchBackend):
+    '''
+    A stand in for the batch API that answers every request with `responder` as soon as it is submitted, writing the output to a file next to the requests.
+
+    `responder` takes a request body and returns a response body, like `GPT.send_request_body`.
+    '''
+
+    def __init__(self, responder: Callable[[dict[str, Any]], dict[str, Any]]) -> None:
+        self.responder = responder
+        self.outputs: dict[str, str] = {}
+
+    def submit(self, requests_path: str) -> str:
+        batch_id = f'local_batch_{uuid.uuid4().hex}'
+        output_path = f'{os.path.splitext(requests_path)[0]}_output.jsonl'
+
+        with open(requests_path) as requests_file, open(output_path, 'w') as output_file:
+            for line in requests_file:
+                if not line.strip():
+                    continue
+
+                request = json.loads(line)
+                output: dict[str, Any] = {'id': f'local_request_{uuid.uuid4().hex}', 'custom_id': request['custom_id'], 'response': None, 'error': None}
+
+                try:
+                    output['response'] = {'status_code': 200, 'body': self.responder(request['body'])}
+                except Exception as exception:
+                    output['error'] = {'code': type(exception).__name__, 'message': str(exception)}
+
+                output_file.write(json.dumps(output) + '\n')
+
+        self.outputs[batch_id] = output_path
+
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        return 'completed' if batch_id in self.outputs else 'failed'
+
+    def results(self, batch_id: str) -> list[dict[str, Any]]:
+        with open(self.outputs[batch_id]) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+
+def write_batch_requests(queries: dict[BatchKey, list[ChatCompletionMessageParam]], path: str) -> None:
+    '''
+    Writes a JSONL file of batch API requests, one for each query. Each request's custom id is the json of its key.
+    '''
+
+    with open(path, 'w') as f:
+        for key, messages in queries.items():
+            request = {
+                'custom_id': json.dumps(key),
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': completion_request_body(messages),
+            }
+
+            f.write(json.dumps(request) + '\n')
+
+
+
+def run_batch_queries(
+        queries: dict[BatchKey, list[ChatCompletionMessageParam]],
+        backend: BatchBackend,
+        poll_interval: float = 60.0,
+        on_new_reply: Callable[[BatchKey, TreatmentPrices], None] | None = None,
+    ) -> dict[BatchKey, TreatmentPrices]:
+
+    '''
+    Sends every query through `backend` in one batch, waits for it to finish, and returns the parsed reply of each query that succeeded.
+
+    Queries already in the completion cache aren't sent, and every new reply is added to the cache and passed to `on_new_reply`.
+    '''
+
+    replies: dict[BatchKey, TreatmentPrices] = {}
+    to_send: dict[BatchKey, list[ChatCompletionMessageParam]] = {}
+
+    for key, messages in queries.items():
+        cached = COMPLETION_CACHE.get(completion_key(messages))
+
+        if cached is None:
+            to_send[key] = messages
+        else:
+            replies[key] = TreatmentPrices.model_validate_json(cached[1])
+
+    if not to_send:
+        return replies
+
+    os.makedirs(BATCH_DIR, exist_ok=True)
+
+    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    requests_path = os.path.join(BATCH_DIR, f'requests_{timestamp}_{uuid.uuid4().hex[:8]}.jsonl')
+
+    write_batch_requests(to_send, requests_path)
+
+    batch_id = backend.submit(requests_path)
+
+    while (status := backend.status(batch_id)) not in ('completed', 'failed', 'expired', 'cancelled'):
+        time.sleep(poll_interval)
+
+    log(f'Batch {batch_id} {status} with {len(to_send)} queries\n', 'gpt_responses.txt')
+
+    if status != 'completed':
+        return replies
+
+    for output in backend.results(batch_id):
+        response = output.get('response')
+
+        if output.get('error') or response is None or response['status_code'] != 200:
+            continue
+
+        key: BatchKey = tuple(json.loads(output['custom_id'])) # type: ignore
+
+        if key not in to_send:
+            continue
+
+        # one bad output shouldn't lose the rest of a batch that's already paid for
+        try:
+            body = response['body']
+            content = body['choices'][0]['message'].get('content')
+
+            if not content:
+                raise ValueError('empty reply')
+
+            reply = TreatmentPrices.model_validate_json(content)
+
+        except (ValidationError, ValueError, KeyError, IndexError, TypeError) as exception:
+            log(f'Skipped batch output {output["custom_id"]}: {type(exception).__name__}: {exception}\n', 'errors.txt')
+            continue
+
+        usage = body.get('usage') or {'prompt_tokens': 0, 'completion_tokens': 0}
+
+        completion = Completion(reply, usage['prompt_tokens'], usage['completion_tokens'], False)
+        log_completion(completion)
+
+        COMPLETION_CACHE.put(
+            completion_key(to_send[key]),
+            {'prompt_tokens': completion.prompt_tokens, 'completion_tokens': completion.completion_tokens},
+            reply.model_dump_json().encode()
+        )
+
+        replies[key] = reply
+
+        if on_new_reply is not None:
+            on_new_reply(key, reply)
+
+    return replies
 
 
 
 def token_count(string: str) -> int:
-    return len(GPT_ENCODING.encode(string))
+    return len(get_encoding().encode(string))
+
+
+
+def messages_token_count(messages: Sequence[ChatCompletionMessageParam]) -> int:
+    '''
+    Estimates the number of prompt tokens in `messages`.
+    '''
+
+    return sum(token_count(message['content']) + MESSAGE_TOKEN_OVERHEAD for message in messages) # type: ignore
 
@@ -0,0 +1,156 @@
+'''
+Module for quickly getting the text out of html, without building a tree of the whole page
+'''
+
+import codecs
+import re
+from html.parser import HTMLParser
+
+
+
+SKIPPED_TAGS = frozenset(('script', 'style', 'noscript', 'template', 'svg', 'nav'))
+RAW_TEXT_TAGS = frozenset(('script', 'style')) # text the parser doesn't look for tags in, never kept
+
+# tags that never have an end tag, so they aren't kept on the stack of open tags
+VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'))
+
+FEED_SIZE = 64 * 1024
+
+_META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.-]+)', re.IGNORECASE)
+
+
+
+class TextExtractor(HTMLParser):
+    '''
+    Collects the stripped text of every element, skipping everything inside `SKIPPED_TAGS`.
+
+    Gives the same text as `BeautifulSoup.get_text(separator='\\n', strip=True)`, apart from the skipped tags.
+
+    The parser can split one piece of text over several `handle_data` calls (like when it crosses the end of a fed chunk),
+    so the pieces are buffered and only joined into a line at the next tag, comment or `close()`.
+
+    Text inside a skipped tag is only thrown away once the tag's own end tag is found. If the tag is left open until an element around it ends or the page ends,
+    the page is broken rather than the tag holding the rest of it, so the skipped text is kept.
+    '''
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+
+        self.parts: list[str] = []
+        self.pending: list[str] = []
+        self.skipped: list[str] = [] # lines inside the open skipped tag
+        self.open_tags: list[str] = []
+        self.skip_start: int | None = None # where the outermost open skipped tag is in `open_tags`
+
+    def flush_text(self) -> None:
+        if self.pending:
+            data = ''.join(self.pending).strip()
+            self.pending.clear()
+
+            if data:
+                (self.parts if self.skip_start is None else self.skipped).append(data)
+
+    def end_skip(self, keep: bool) -> None:
+        if keep:
+            self.parts.extend(self.skipped)
+
+        self.skipped.clear()
+        self.skip_start = None
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        self.flush_text()
+
+        if tag in VOID_TAGS:
+            return
+
+        if tag in SKIPPED_TAGS and self.skip_start is None:
+            self.skip_start = len(self.open_tags)
+
+        self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs) -> None:
+        self.flush_text()
+
+    def handle_endtag(self, tag: str) -> None:
+        self.flush_text()
+
+        # end tags without a start tag are ignored
+        if tag not in self.open_tags:
+            return
+
+        # close the tag, along with anything inside it that was left open
+        index = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+
+        del self.open_tags[index:]
+
+        if self.skip_start is not None and index <= self.skip_start:
+            self.end_skip(keep=index < self.skip_start)
+
+    def handle_comment(self, data: str) -> None:
+        self.flush_text()
+
+    def handle_data(self, data: str) -> None:
+        if not (self.open_tags and self.open_tags[-1] in RAW_TEXT_TAGS):
+            self.pending.append(data)
+
+    def close(self) -> None:
+        super().close()
+
+        self.flush_text()
+
+        if self.skip_start is not None:
+            self.end_skip(keep=True)
+
+    def get_text(self) -> str:
+        return '\n'.join(self.parts)
+
+
+
+def detect_encoding(content_type: str | None, body: bytes) -> str:
+    '''
+    Returns the encoding of an html page from its Content-Type header or a `<meta charset>` tag, falling back to utf-8.
+
+    Never guesses from the bytes themselves, since that is slow on big pages.
+    '''
+
+    if content_type:
+        for parameter in content_type.split(';')[1:]:
+            name, _, value = parameter.partition('=')
+
+            if name.strip().lower() == 'charset' and value.strip():
+                return _checked_encoding(value.strip().strip('"\''))
+
+    match = _META_CHARSET.search(body, 0, 4096)
+
+    if match:
+        return _checked_encoding(match.group(1).decode('ascii'))
+
+    return 'utf-8'
+
+
+
+def _checked_encoding(encoding: str) -> str:
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return 'utf-8'
+
+
+
+def html_to_text(body: bytes, encoding: str) -> str:
+    '''
+    Decodes `body` and returns its text, one piece of text per line.
+
+    The page is decoded and parsed a piece at a time, so a big page is never held as one huge string.
+    '''
+
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parser = TextExtractor()
+
+    for start in range(0, len(body), FEED_SIZE):
+        parser.feed(decoder.decode(body[start:start + FEED_SIZE]))
+
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+
+    return parser.get_text()
@@ -0,0 +1,155 @@
+'''
+Module containing a shared, thread safe http session that keeps connections alive and limits how hard each host gets hit
+'''
+
+import time
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from constants import MAX_CONNECTIONS_PER_HOST, POLITENESS_DELAY, HOST_LIMITS
+
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+
+class HostLimiter:
+    '''
+    Limits the number of connections open to one host at a time, and spaces out the start of each request by `delay` seconds.
+    '''
+
+    __slots__ = ('connections', 'delay', 'next_start', 'lock')
+
+    def __init__(self, max_connections: int, delay: float) -> None:
+        self.connections = BoundedSemaphore(max_connections)
+        self.delay = delay
+        self.next_start = 0.0
+        self.lock = Lock()
+
+    def __enter__(self) -> 'HostLimiter':
+        self.connections.acquire()
+
+        # reserve the next start time, then wait for it outside of the lock
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.delay
+
+        if start > now:
+            time.sleep(start - now)
+
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.connections.release()
+
+
+
+class SessionPool:
+    '''
+    A `requests.Session` shared between threads, with a pool of kept alive connections for each host.
+    '''
+
+    __slots__ = ('session', 'max_connections_per_host', 'delay', 'host_limits', 'hosts', 'lock')
+
+    def __init__(
+            self,
+            max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+            delay: float = POLITENESS_DELAY,
+            host_limits: dict[str, tuple[int, float]] = HOST_LIMITS,
+        ) -> None:
+
+        self.max_connections_per_host = max_connections_per_host
+        self.delay = delay
+        self.host_limits = dict(host_limits)
+        self.hosts: dict[str, HostLimiter] = {}
+        self.lock = Lock()
+
+        # keep enough idle connections around for every limited host
+        pool_size = max([max_connections_per_host, *(connections for connections, _ in self.host_limits.values())])
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_size)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_host_limiter(self, url: str) -> HostLimiter:
+        host = urlsplit(url).netloc.lower()
+
+        with self.lock:
+            if host not in self.hosts:
+                connections, delay = self.host_limits.get(host, (self.max_connections_per_host, self.delay))
+
+                self.hosts[host] = HostLimiter(connections, delay)
+
+            return self.hosts[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        '''
+        Same as `requests.get`, but reuses connections and waits for the host's limits.
+        '''
+
+        with self.get_host_limiter(url):
+            return self.session.get(url, **kwargs)
+
+    def get_capped(self, url: str, max_bytes: int, **kwargs) -> tuple[requests.Response, bytes, bool]:
+        '''
+        Streams the body of a get request, stopping once `max_bytes` bytes have been read.
+
+        Returns the response, the body, and whether the body was cut off. The connection counts against the host's limit until the body is read.
+        '''
+
+        with self.get_host_limiter(url):
+            with self.session.get(url, stream=True, **kwargs) as response:
+                chunks: list[bytes] = []
+                size = 0
+                truncated = False
+
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    chunks.append(chunk)
+                    size += len(chunk)
+
+                    # stop downloading, the rest of the body is thrown away with the connection
+                    if size >= max_bytes:
+                        truncated = True
+
+                        break
+
+        return response, b''.join(chunks)[:max_bytes], truncated
+
+
+
+SESSION = SessionPool()
+
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    '''
+    `SessionPool.get` on the shared session.
+    '''
+
+    return SESSION.get(url, **kwargs)
+
+
+
+def get_capped(url: str, max_bytes: int, **kwargs) -> tuple[requests.Response, bytes, bool]:
+    '''
+    `SessionPool.get_capped` on the shared session.
+    '''
+
+    return SESSION.get_capped(url, max_bytes, **kwargs)
+
+
+
+def configure(max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST, delay: float = POLITENESS_DELAY, host_limits: dict[str, tuple[int, float]] = HOST_LIMITS) -> None:
+    '''
+    Replaces the shared session with one using different limits.
+    '''
+
+    global SESSION
+
+    SESSION = SessionPool(max_connections_per_host, delay, host_limits)
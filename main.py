@@ -1,3 +1,5 @@
+from startup import report_startup # imported first so the startup time includes every other import
+
 import tkinter as tk
 import tkinter.messagebox as messagebox
 from threading import Thread
@@ -8,7 +10,7 @@ import pyperclip
 from constants import *
 from pricing import PriceManager
 from treatments import Treatment, TREATMENTS
-from zipcode import Zipcode
+from zipcode import Zipcode, get_zip_index
 
 
 
@@ -72,10 +74,71 @@ def city_update(*_) -> None:
         if not _update_city.get():
             zipcode_str.set('')
 
+            show_city_suggestions(city)
+
+        else:
+            hide_city_suggestions()
+
         _update_city.set(False)
 
 
 
+def show_city_suggestions(city: str) -> None:
+    # a couple of letters are needed before the list is short enough to be useful
+    matches = Zipcode.complete_city(city, CITY_SUGGESTIONS) if len(city.strip()) >= 2 else []
+
+    if not matches or matches == [city]:
+        hide_city_suggestions()
+
+        return
+
+    city_suggestions.delete(0, 'end')
+    city_suggestions.insert('end', *matches)
+    city_suggestions.configure(height=len(matches))
+
+    city_suggestions.place(
+        x = city_entry.winfo_x(),
+        y = city_entry.winfo_y() + city_entry.winfo_height()
+    )
+    city_suggestions.lift()
+
+
+
+def hide_city_suggestions(*_) -> None:
+    city_suggestions.place_forget()
+
+
+
+def choose_city_suggestion(*_) -> None:
+    selection = city_suggestions.curselection()
+
+    if selection:
+        city_str.set(city_suggestions.get(selection[0]))
+
+    hide_city_suggestions()
+
+    city_entry.focus_set()
+    city_entry.icursor('end')
+
+
+
+def focus_city_suggestions(*_) -> None:
+    if city_suggestions.winfo_ismapped():
+        city_suggestions.focus_set()
+        city_suggestions.selection_clear(0, 'end')
+        city_suggestions.selection_set(0)
+        city_suggestions.activate(0)
+
+
+
+def window_click(event: tk.Event) -> None:
+    event.widget.focus_set()
+
+    if event.widget not in (city_entry, city_suggestions):
+        hide_city_suggestions()
+
+
+
 def checkbox_update(*_) -> None:
     query_button['state'] = 'normal' if submit_active() else 'disabled'
 
@@ -209,6 +272,16 @@ city_entry.place(
     y = entry_y + 2
 )
 
+# matching cities, shown under the city box while typing
+city_suggestions = tk.Listbox(
+    window,
+    font=DEFAULT_FONT,
+    width=25,
+    height=CITY_SUGGESTIONS,
+    activestyle='none',
+    **ENTRY_COLORS
+)
+
 # Add treatment options
 checkbox_y = entry_y + city_entry.winfo_reqheight() + 27
 checkboxes: list[tk.Checkbutton] = []
@@ -266,6 +339,9 @@ query_button.place(
 # create the price manager
 price_manager = PriceManager()
 
+# load the zip code index in the background so the first lookup doesn't wait for it
+Thread(target=get_zip_index, daemon=True).start()
+
 
 # link everything together
 zipcode_str.trace_add('write', zipcode_update)
@@ -274,11 +350,18 @@ city_str.trace_add('write', city_update)
 for _, checkbox_state in treatment_checkboxes:
     checkbox_state.trace_add('write', checkbox_update)
 
+city_entry.bind('<Down>', focus_city_suggestions)
+city_entry.bind('<Escape>', hide_city_suggestions)
+city_suggestions.bind('<ButtonRelease-1>', choose_city_suggestion)
+city_suggestions.bind('<Return>', choose_city_suggestion)
+city_suggestions.bind('<Escape>', lambda _: (hide_city_suggestions(), city_entry.focus_set()))
+
 
 # fix focusing issues
-window.bind_all('<Button>', lambda event: event.widget.focus_set())
+window.bind_all('<Button>', window_click)
 
 
 # run
+window.after_idle(report_startup, 'window')
 window.mainloop()
 
@@ -2,94 +2,246 @@
 Module for getting the pricing information of massages using a specific website where you can input a latitude and longitude
 '''
 
-from statistics import median
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import json
+import math
+import re
+import time
+
+import numpy as np
+import numpy.typing as npt
 
 import web_scraper
+from cache import DiskCache
+from constants import MASSAGE_CACHE_MAX_BYTES, MASSAGE_CACHE_TTL, MASSAGE_MAX_LISTINGS, MASSAGE_MAX_PAGES
+from html_text import html_to_text
+from log import log
+from scheduler import get_stage
 from zipcode import Zipcode
 
 
 
-def get_massage_pricing(zipcode: Zipcode, durations: list[int], max_dist: float) -> dict[int, float]:
+SEARCH_URL = 'https://www.massagebook.com/search/massage-therapy?latlng={},{}'
+
+LISTING_CACHE = DiskCache('massage_listings', MASSAGE_CACHE_MAX_BYTES) # one entry per zip code, so saving one doesn't rewrite the rest
+
+CRAWL_WORKERS = 4 # zip codes crawled at once by `get_regional_massage_pricing`, each fetching its pages on the fetch stage
+
+# every listing starts with its distance, followed by the lengths and prices of its massages
+DISTANCE = re.compile(r'(\d+(?:\.\d+)?)\s*miles?\s+away', re.IGNORECASE)
+DURATION = re.compile(r'\b(\d{1,3})\s*min', re.IGNORECASE)
+PRICE = re.compile(r'\$\s*(\d[\d,]*(?:\.\d{1,2})?)')
+
+IntArray = npt.NDArray[np.int64]
+FloatArray = npt.NDArray[np.float64]
+
+
+
+@dataclass(slots=True, frozen=True)
+class Listing:
     '''
-    Get the average price of a `duration` minute massage within `max_dist` miles of `zipcode`.
-    
-    Uses a specific website for higher accuracy.
+    One massage offered by a therapist: how far away they are in miles, how long it is in minutes and how much it costs.
+    '''
+
+    distance: float
+    duration: int
+    price: float
+
+
 
-    Doesn't work well for `duration <= 45`.
+def parse_listings(text: str) -> list[Listing]:
     '''
+    Returns every massage listed in the text of a results page.
 
-    url = f'https://www.massagebook.com/search/massage-therapy?latlng={zipcode.lat},{zipcode.long}'
+    The text is split into one segment per therapist at each "miles away", and each duration in a segment is paired with the next price before the following duration.
+    '''
+
+    listings: list[Listing] = []
+    markers = list(DISTANCE.finditer(text))
 
-    massage_data = web_scraper.get_website_data(url, {'min': 1, '$': 1, 'miles': 1}, 0)
+    for marker, next_marker in zip(markers, markers[1:] + [None]):
+        distance = float(marker.group(1))
+        segment = text[marker.end():next_marker.start() if next_marker else len(text)]
 
-    # extract the duration and price of each massage
-    time_cost: dict[int, list[float]] = {}
+        durations = list(DURATION.finditer(segment))
 
-    dist = time = cost = 0
+        for duration, next_duration in zip(durations, durations[1:] + [None]):
+            price = PRICE.search(segment, duration.end(), next_duration.start() if next_duration else len(segment))
 
-    for line in massage_data.splitlines():
-        if 'mile' in line:
-            if time or cost: # reset if the order is messed up
-                dist = time = cost = 0
+            if price is None or not int(duration.group(1)):
                 continue
 
-            else:
-                dist = float(line.strip('miles away '))
+            listings.append(Listing(distance, int(duration.group(1)), float(price.group(1).replace(',', ''))))
 
-                if dist > max_dist:
-                    dist = time = cost = 0
-                    continue
+    return listings
 
-        elif 'min' in line:
-            if (not dist) or time or cost: # reset if the order is messed up
-                dist = time = cost = 0
-                continue
 
-            else:
-                time = int(line.strip('min '))
 
-        elif '$' in line:
-            if (not dist) or (not time) or cost: # reset if the order is messed up
-                dist = time = cost = 0
-                continue
+def page_url(zipcode: Zipcode, page: int) -> str:
+    url = SEARCH_URL.format(zipcode.lat, zipcode.long)
+
+    return url if page == 1 else f'{url}&page={page}'
+
+
+
+def crawl_page(url: str) -> list[Listing]:
+    page = web_scraper.fetch_page(url)
+
+    if page is None:
+        return []
+
+    return parse_listings(html_to_text(*page))
+
+
+
+def get_listings(zipcode: Zipcode, max_listings: int = MASSAGE_MAX_LISTINGS) -> list[Listing]:
+    '''
+    Returns up to `max_listings` massages listed on massagebook around `zipcode`, closest first.
+
+    The first results page shows how many listings each page has, then the rest of the pages needed are fetched at once on the fetch stage, up to `MASSAGE_MAX_PAGES` pages.
+    A page that repeats one already seen ends the crawl, so results that ignore the page number aren't counted more than once.
+    Listings are cached for each zip code for `MASSAGE_CACHE_TTL` seconds.
+    '''
+
+    # crawls for fewer listings can't answer requests for more
+    cached = LISTING_CACHE.get(zipcode.zipcode)
+
+    if cached is not None:
+        metadata, body = cached
+
+        if metadata['expires'] > time.time() and metadata['max_listings'] >= max_listings:
+            return [Listing(*listing) for listing in json.loads(body)[:max_listings]]
+
+    listings = crawl_page(page_url(zipcode, 1))
+
+    if listings:
+        pages = min(MASSAGE_MAX_PAGES, math.ceil(max_listings / len(listings)))
+        urls = [page_url(zipcode, page) for page in range(2, pages + 1)]
+
+        seen_pages = {tuple(listings)}
+
+        for page_listings in get_stage('fetch').map(crawl_page, urls):
+            # the pages after an empty or repeated one are past the end of the results
+            if not page_listings or tuple(page_listings) in seen_pages:
+                break
+
+            seen_pages.add(tuple(page_listings))
+            listings.extend(page_listings)
 
-            else:
-                cost = float(line.strip('$ ').replace(',', ''))
+    listings = sorted(listings, key=lambda listing: listing.distance)[:max_listings]
 
-        if dist and time and cost:
-            if time not in time_cost:
-                time_cost[time] = []
+    log(f'{zipcode.zipcode}: {len(listings)} massage listings\n', 'massages.txt')
 
-            time_cost[time].append(cost)
+    if listings:
+        LISTING_CACHE.put(
+            zipcode.zipcode,
+            {'expires': time.time() + MASSAGE_CACHE_TTL, 'max_listings': max_listings},
+            json.dumps([[listing.distance, listing.duration, listing.price] for listing in listings]).encode()
+        )
 
-            dist = time = cost = 0
+    return listings
 
-    samples: list[int] = []
-    prices: list[float] = []
 
-    # get the price for each massage duration
-    for duration in durations:
-        # get the price per minute of all massages within `variance` minutes of the specified duration
-        ppms: list[float] = []
-        variance = 5 * round(duration ** 0.5 / 5)
 
-        for time in time_cost:
-            if abs(time - duration) <= variance:
-                ppms.extend(map(lambda i: i / time, time_cost[time]))
+def listing_arrays(listings: list[list[Listing]]) -> tuple[IntArray, FloatArray, IntArray, FloatArray]:
+    '''
+    Flattens the listings of several zip codes into the arrays `aggregate_prices` takes: the index of each listing's zip code, its distance, minutes and cost.
+    '''
+
+    flat = [listing for zip_listings in listings for listing in zip_listings]
+
+    return (
+        np.repeat(np.arange(len(listings)), [len(zip_listings) for zip_listings in listings]),
+        np.array([listing.distance for listing in flat], dtype=np.float64),
+        np.array([listing.duration for listing in flat], dtype=np.int64),
+        np.array([listing.price for listing in flat], dtype=np.float64),
+    )
+
+
+
+def aggregate_prices(
+        zip_indices: IntArray,
+        distances: FloatArray,
+        minutes: IntArray,
+        costs: FloatArray,
+        zip_count: int,
+        durations: list[int],
+        max_dist: float | FloatArray,
+    ) -> tuple[FloatArray, IntArray]:
+
+    '''
+    Gets the average price of each of `durations` minute massage in each of `zip_count` zip codes, from listings given as arrays (see `listing_arrays`).
+
+    For each zip code and duration, the samples are the prices per minute of the listings within `max_dist` miles (one for all zip codes, or one each) whose minutes are within `5 * round(sqrt(duration) / 5)` of the duration.
+    Samples less than half of or more than double the median are removed, and the rest are averaged and multiplied by the duration.
+
+    Returns a zip code by duration matrix of prices (NaN where there are no samples) and a matching matrix of sample counts.
+    '''
+
+    duration_array = np.asarray(durations, dtype=np.int64)
+    variances = 5 * np.round(duration_array ** 0.5 / 5)
+
+    max_dists = np.broadcast_to(np.asarray(max_dist, dtype=np.float64), (zip_count,))
+    close = distances <= max_dists[zip_indices]
+
+    # one sample for every listing and duration window it falls in
+    listing_index, duration_index = np.nonzero(close[:, None] & (np.abs(minutes[:, None] - duration_array[None, :]) <= variances[None, :]))
+
+    groups = zip_indices[listing_index] * len(durations) + duration_index
+    ppms = costs[listing_index] / minutes[listing_index]
+
+    group_count = zip_count * len(durations)
+    sizes = np.bincount(groups, minlength=group_count)
+
+    # the median of each group, from the samples sorted by group then price per minute
+    order = np.lexsort((ppms, groups))
+    sorted_ppms = ppms[order]
+    starts = np.cumsum(sizes) - sizes
+
+    has_samples = sizes > 0
+    medians = np.full(group_count, np.nan)
+    medians[has_samples] = 0.5 * (sorted_ppms[(starts + (sizes - 1) // 2)[has_samples]] + sorted_ppms[(starts + sizes // 2)[has_samples]])
+
+    # remove prices per minute that are less than half of or more than double the median, then average the rest
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.abs(ppms / medians[groups])
 
-        if not ppms:
-            continue
+    keep = (0.5 < ratios) & (ratios < 2)
 
-        # remove prices per minute that are less than half of or more than double the median
-        med = median(ppms)
-        no_outliers = list(filter(lambda x: 0.5 < abs(x / med) < 2, ppms))
+    counts = np.bincount(groups[keep], minlength=group_count)
+    totals = np.bincount(groups[keep], weights=ppms[keep], minlength=group_count)
 
-        # calculate average
-        sample_size = len(no_outliers)
-        ppm = sum(no_outliers) / sample_size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prices = np.where(counts > 0, totals / counts, np.nan).reshape(zip_count, len(durations)) * duration_array[None, :]
+
+    return prices, counts.reshape(zip_count, len(durations))
+
+
+
+def get_regional_massage_pricing(zipcodes: list[Zipcode], durations: list[int], max_dist: float) -> tuple[FloatArray, IntArray]:
+    '''
+    Gets the average price of each of `durations` minute massage within `max_dist` miles of each of `zipcodes`, as a zip code by duration matrix of prices and one of sample counts (see `aggregate_prices`).
+
+    The zip codes' listings are crawled `CRAWL_WORKERS` at a time.
+    '''
+
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+        listings = list(executor.map(get_listings, zipcodes))
+
+    return aggregate_prices(*listing_arrays(listings), len(zipcodes), durations, max_dist)
+
+
+
+def get_massage_pricing(zipcode: Zipcode, durations: list[int], max_dist: float) -> dict[int, float]:
+    '''
+    Get the average price of a `duration` minute massage within `max_dist` miles of `zipcode`.
+
+    Uses a specific website for higher accuracy.
+
+    Doesn't work well for `duration <= 45`. Durations without any samples are left out.
+    '''
 
-        samples.append(sample_size)
-        prices.append(ppm * duration)
-    
-    return {duration: price for duration, price in zip(durations, prices)}
+    prices, counts = aggregate_prices(*listing_arrays([get_listings(zipcode)]), 1, durations, max_dist)
 
+    return {duration: float(price) for duration, price, count in zip(durations, prices[0], counts[0]) if count}
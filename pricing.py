@@ -2,85 +2,270 @@
 Module for getting the pricing information of treatments is different zipcodes and cities
 '''
 
-from queue import Queue
-from threading import Thread, Lock
+from concurrent.futures import Future
+from threading import Lock
+from typing import TYPE_CHECKING
 
 import database
+from constants import DATABASE_BACKEND, ESTIMATE_MIN_CONFIDENCE, ESTIMATE_PRICES, MERGE_TREATMENT_QUERIES, STAGE_WORKERS
 from database import PricingData
-from gpt import GPT
+from log import log
+from scheduler import Stage, configure_stages
 from treatments import Treatment
 from zipcode import Zipcode
 
+if TYPE_CHECKING:
+    from estimate import Estimate
+    from gpt import GPT, BatchBackend, BatchKey, TreatmentPrices
+    from samples import Aggregates
+
 
 
 class PriceManager:
-    __slots__ = ('gpt', 'database')
+    __slots__ = ('_gpt', '_gpt_lock', 'database', 'jobs', 'estimate')
 
-    def __init__(self) -> None:
-        self.gpt = GPT()
-        self.database = database.load()
+    def __init__(self, stage_workers: dict[str, int] | None = None, database_backend: str = DATABASE_BACKEND, estimate: bool = ESTIMATE_PRICES) -> None:
+        '''
+        `stage_workers` sets the number of workers for any of the stages in `STAGE_WORKERS` ('jobs', 'search', 'fetch' and 'llm').
 
-    def get_saved_pricing(self, zipcode: Zipcode) -> PricingData:
-        city = zipcode.city
+        `database_backend` is either 'sqlite' or 'json'.
+
+        If `estimate` is set, prices that aren't saved are estimated from nearby cities first, and only queried if the estimate isn't confident enough.
+        '''
+
+        stage_workers = stage_workers or {}
 
-        if city in self.database:
-            return self.database[city]
+        if stage_workers:
+            configure_stages({name: count for name, count in stage_workers.items() if name != 'jobs'})
 
-        else:
-            return {}
+        self._gpt: 'GPT | None' = None
+        self._gpt_lock = Lock()
+        self.database = database.load(database_backend)
+        self.jobs = Stage('jobs', stage_workers.get('jobs', STAGE_WORKERS['jobs']))
+        self.estimate = estimate
 
-    def get_prices_per_minute(self, city: str, treatments: list[Treatment], update_database: bool) -> PricingData:
+    @property
+    def gpt(self) -> 'GPT':
+        '''
+        The GPT client. openai and pydantic are only imported the first time it's used, so creating a price manager is quick.
+
+        The samples of every new reply are saved to a `SampleStore`.
+        '''
+
+        with self._gpt_lock:
+            if self._gpt is None:
+                from gpt import GPT
+                from samples import SampleStore
+
+                self._gpt = GPT(SampleStore())
+
+            return self._gpt
+
+    def get_saved_pricing(self, zipcode: Zipcode) -> PricingData:
+        return self.database.get_pricing(zipcode.city)
+
+    def get_prices_per_minute(self, city: str, treatments: list[Treatment], update_database: bool, merged: bool = MERGE_TREATMENT_QUERIES) -> PricingData:
         '''
         Gets the prices per minute for each listed treatment and returns the result.
 
+        If `merged` is set, all of the treatments share one search and GPT call (see `get_city_prices_per_minute`).
+
         Intended to run on a separate thread.
         '''
 
-        # create threads for each treatment and a shared lock
-        threads: list[Thread] = []
+        if merged and len(treatments) > 1:
+            try:
+                prices = self.submit_city(city, treatments, update_database).result()
+            except Exception as exception:
+                log(f'Failed to price {city}: {type(exception).__name__}: {exception}\n', 'errors.txt')
 
-        queue: Queue[PricingData] = Queue()
-        lock = Lock()
+                prices = {}
 
-        for treatment in treatments:
-            thread = Thread(target=self.price_worker, args=(city, treatment, update_database, queue, lock))
+            self.save()
 
-            thread.start()
+            return prices
 
-            threads.append(thread)
+        # queue a job for each treatment
+        futures = {treatment.name: self.submit(city, treatment, update_database) for treatment in treatments}
 
-        # wait for threads to finish
-        for thread in threads:
-            thread.join()
+        # wait for the jobs to finish
+        prices: PricingData = {}
 
-        # save database and put return value in queue
-        database.save(self.database)
+        for name, future in futures.items():
+            try:
+                prices[name] = future.result()
+            except Exception as exception:
+                log(f'Failed to price {name} in {city}: {type(exception).__name__}: {exception}\n', 'errors.txt')
 
-        prices: PricingData = {}
+        self.save()
+
+        return prices
+
+    def submit(self, city: str, treatment: Treatment, update_database: bool) -> Future[float]:
+        '''
+        Queues a job to get the price per minute of a treatment. Jobs for every city share the same workers.
+        '''
+
+        return self.jobs.submit(self.get_price_per_minute, city, treatment, update_database)
+
+    def submit_city(self, city: str, treatments: list[Treatment], update_database: bool, single_call: bool = True) -> Future[PricingData]:
+        '''
+        Queues a job to get the prices per minute of several treatments in one city together.
+        '''
+
+        return self.jobs.submit(self.get_city_prices_per_minute, city, treatments, update_database, single_call)
+
+    def get_city_prices_per_minute(self, city: str, treatments: list[Treatment], update_database: bool, single_call: bool = True) -> PricingData:
+        '''
+        Gets the prices per minute of several treatments in one city, with one search and set of sources for all of the treatments that need querying.
+
+        If `single_call` is set, GPT is asked about them all in one query, otherwise there is one query per treatment using the shared sources.
+
+        Doesn't save the database. Treatments that couldn't be priced are left out.
+        '''
+
+        prices = self.database.get_pricing(city)
+
+        to_query = [treatment for treatment in treatments if update_database or treatment.name not in prices]
+
+        if self.estimate and not update_database:
+            for treatment in to_query[:]:
+                estimate = self.get_confident_estimate(city, treatment)
+
+                if estimate is not None:
+                    prices[treatment.name] = estimate
+                    to_query.remove(treatment)
+
+        if to_query:
+            for name, price in self.gpt.query_city_pricing(city, to_query, single_call).items():
+                prices[name] = round(price, 2)
+
+                self.database.set_price(city, name, prices[name])
+
+        return {treatment.name: prices[treatment.name] for treatment in treatments if treatment.name in prices}
+
+    def get_price_per_minute(self, city: str, treatment: Treatment, update_database: bool) -> float:
+        '''
+        Gets the price per minute of one treatment, querying GPT if it isn't saved or `update_database` is set.
+
+        When estimating, an unsaved price that can be confidently estimated from nearby cities isn't queried.
 
-        while True:
+        Doesn't save the database. Safe to call from many threads at once.
+        '''
+
+        saved = self.database.get_price(city, treatment.name)
+
+        if saved is None and self.estimate and not update_database:
+            saved = self.get_confident_estimate(city, treatment)
+
+        if saved is None or update_database:
+            saved = round(self.gpt.query_treatment_pricing(city, treatment), 2)
+
+            self.database.set_price(city, treatment.name, saved)
+
+        return saved
+
+    def estimate_price_per_minute(self, city: str, treatment: Treatment) -> 'Estimate | None':
+        '''
+        Estimates the price per minute of a treatment from the saved prices of nearby cities (see `estimate.estimate_price`).
+        '''
+
+        from estimate import estimate_price
+
+        return estimate_price(city, self.database.get_treatment_prices(treatment.name))
+
+    def get_confident_estimate(self, city: str, treatment: Treatment) -> float | None:
+        '''
+        Returns the estimated price per minute of a treatment if its confidence is at least `ESTIMATE_MIN_CONFIDENCE`, otherwise `None`.
+
+        Estimates aren't saved to the database, so they're never used to estimate other cities.
+        '''
+
+        estimate = self.estimate_price_per_minute(city, treatment)
+
+        if estimate is None:
+            log(f'{treatment.name} in {city}: not enough nearby prices to estimate\n', 'estimates.txt')
+
+            return None
+
+        log(f'{treatment.name} in {city}: ${estimate.price_per_minute:.2f} per minute, confidence {estimate.confidence:.2f} from {", ".join(estimate.neighbors)}\n', 'estimates.txt')
+
+        if estimate.confidence < ESTIMATE_MIN_CONFIDENCE:
+            return None
+
+        return round(estimate.price_per_minute, 2)
+
+    def refresh_offline(self, jobs: list[tuple[str, Treatment]], backend: 'BatchBackend', poll_interval: float = 60.0) -> 'dict[BatchKey, float]':
+        '''
+        Gets new prices for every (city, treatment) job with one batch of GPT queries instead of one call each, and saves them to the database.
+
+        Sources are still searched for and scraped on the jobs stage. Blocks until the batch finishes, which can take hours.
+        '''
+
+        from gpt import assemble_messages, run_batch_queries
+
+        # scrape the sources for every job
+        futures = {(city, treatment): self.jobs.submit(self.gpt.get_treatment_sources, city, treatment) for city, treatment in jobs}
+
+        queries = {}
+        sources = {}
+
+        for (city, treatment), future in futures.items():
             try:
-                prices.update(queue.get(block=False))
-            except:
-                break
+                job_sources = future.result()
+            except Exception as exception:
+                log(f'Failed to scrape {treatment.name} in {city}: {type(exception).__name__}: {exception}\n', 'errors.txt')
+                continue
+
+            query = assemble_messages(job_sources, treatment.get_prompt(city))
+
+            if query is not None:
+                queries[(city, treatment.name)] = query[0]
+                sources[(city, treatment.name)] = job_sources
+
+        # send all of the queries at once and save the results
+        prices: 'dict[BatchKey, float]' = {}
+
+        def record_samples(key: 'BatchKey', reply: 'TreatmentPrices') -> None:
+            self.gpt.record_samples(*key, reply, sources[key])
+
+        for (city, treatment_name), reply in run_batch_queries(queries, backend, poll_interval, record_samples).items():
+            price = round(reply.get_pricing(), 2)
+
+            self.database.set_price(city, treatment_name, price)
+
+            prices[(city, treatment_name)] = price
+
+        self.save()
 
         return prices
 
-    def price_worker(self, city: str, treatment: Treatment, update_database: bool, queue: Queue[PricingData], lock: Lock) -> None:
+    def recompute_prices(self, statistic: str = 'mean', latest_only: bool = True, write: bool = False) -> 'Aggregates':
         '''
-        Worker function for getting the price of a treatment
+        Works out the prices of every city and treatment again from the saved samples (see `samples.recompute`), without querying anything.
 
-        Intended to run on a separate thread.
+        If `write` is set, `statistic` ('mean', 'trimmed_mean' or 'median') of each is saved to the database as its price.
         '''
 
-        if city not in self.database or treatment.name not in self.database[city] or update_database:
-            ppm = round(self.gpt.query_treatment_pricing(city, treatment), 2)
+        from samples import load_samples, recompute
+
+        # write out any samples still in memory first
+        self.save()
 
-            with lock:
-                if city not in self.database:
-                    self.database[city] = {}
+        aggregates = recompute(load_samples(), latest_only)
+
+        if write:
+            aggregates.write_to(self.database, statistic)
+
+        return aggregates
+
+    def save(self) -> None:
+        '''
+        Saves the database to disk (which does nothing for databases that save as they go) and writes any samples still in memory.
+        '''
 
-                self.database[city][treatment.name] = ppm
+        self.database.save()
 
-        queue.put({treatment.name: self.database[city][treatment.name]})
+        if self._gpt is not None and self._gpt.samples is not None:
+            self._gpt.samples.flush()
 
@@ -0,0 +1,138 @@
+'''
+Module for choosing which parts of the sources to send to GPT, by scoring chunks of every source for pricing information and packing the best into the token budget
+'''
+
+import math
+import re
+
+from constants import SELECTION_CHUNK_LINES
+from document import Document
+
+
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+PRICE = re.compile(r'\$\s?\d[\d,]*(?:\.\d{2})?')
+DURATION = re.compile(r'\b\d{1,3}\s?(?:min|mins|minutes|minute|hr|hrs|hour|hours)\b', re.IGNORECASE)
+
+PATTERN_WEIGHT = 2.0 # how much more a price or duration counts than a keyword
+PAIR_BONUS = 1.0 # extra score for chunks with both a price and a duration
+
+
+
+class Chunk:
+    __slots__ = ('source', 'indices', 'tokens', 'score')
+
+    def __init__(self, source: int, indices: range, tokens: int) -> None:
+        self.source = source
+        self.indices = indices
+        self.tokens = tokens
+        self.score = 0.0
+
+
+
+def _term_counts(text: str, keywords: list[str]) -> dict[str, int]:
+    lowercase_text = text.lower()
+
+    counts = {keyword: lowercase_text.count(keyword) for keyword in keywords}
+    counts['$price'] = len(PRICE.findall(text))
+    counts['$duration'] = len(DURATION.findall(text))
+
+    return counts
+
+
+
+def score_chunks(documents: list[Document], keywords: dict[str, int]) -> list[Chunk]:
+    '''
+    Splits every document into chunks of `SELECTION_CHUNK_LINES` lines and scores them with BM25.
+
+    The query terms are the keywords, plus prices and durations, which count `PATTERN_WEIGHT` times as much.
+    '''
+
+    terms = list({keyword.lower() for keyword in keywords})
+    weights = {term: 1.0 for term in terms} | {'$price': PATTERN_WEIGHT, '$duration': PATTERN_WEIGHT}
+
+    chunks: list[Chunk] = []
+    counts: list[dict[str, int]] = []
+
+    for source, document in enumerate(documents):
+        for start in range(0, len(document.lines), SELECTION_CHUNK_LINES):
+            indices = range(start, min(start + SELECTION_CHUNK_LINES, len(document.lines)))
+
+            chunks.append(Chunk(source, indices, sum(len(document.line_tokens[i]) for i in indices)))
+            counts.append(_term_counts(''.join(document.lines[i] for i in indices), terms))
+
+    if not chunks:
+        return chunks
+
+    # how rare each term is across all of the chunks
+    average_tokens = sum(chunk.tokens for chunk in chunks) / len(chunks) or 1.0
+    inverse_frequency = {}
+
+    for term in weights:
+        frequency = sum(1 for chunk_counts in counts if chunk_counts[term])
+        inverse_frequency[term] = math.log((len(chunks) - frequency + 0.5) / (frequency + 0.5) + 1)
+
+    for chunk, chunk_counts in zip(chunks, counts):
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk.tokens / average_tokens)
+
+        for term, weight in weights.items():
+            count = chunk_counts[term]
+
+            if count:
+                chunk.score += weight * inverse_frequency[term] * count * (BM25_K1 + 1) / (count + length_norm)
+
+        if chunk_counts['$price'] and chunk_counts['$duration']:
+            chunk.score += PAIR_BONUS
+
+    return chunks
+
+
+
+def select_chunks(documents: list[Document], keywords: dict[str, int], max_tokens: int, min_sources: int) -> list[Document]:
+    '''
+    Returns the parts of `documents` with the most pricing information that fit in `max_tokens` tokens.
+
+    The best chunk of each of the first `min_sources` sources with anything relevant is picked first, so GPT sees a range of providers.
+    The rest of the budget goes to the chunks with the highest score per token.
+
+    Chunks keep their original order, and documents keep their search rank order. Documents with nothing picked are left out.
+    '''
+
+    chunks = [chunk for chunk in score_chunks(documents, keywords) if chunk.score > 0]
+
+    picked: set[int] = set()
+    tokens_left = max_tokens
+
+    def pick(chunk_index: int) -> None:
+        nonlocal tokens_left
+
+        picked.add(chunk_index)
+        tokens_left -= chunks[chunk_index].tokens
+
+    # the best chunk from each of the top sources
+    best_per_source: dict[int, int] = {}
+
+    for i, chunk in enumerate(chunks):
+        if chunk.source not in best_per_source or chunk.score > chunks[best_per_source[chunk.source]].score:
+            best_per_source[chunk.source] = i
+
+    for source in sorted(best_per_source)[:min_sources]:
+        i = best_per_source[source]
+
+        if chunks[i].tokens <= tokens_left:
+            pick(i)
+
+    # then the densest chunks until the budget runs out
+    for i in sorted(range(len(chunks)), key=lambda i: chunks[i].score / max(1, chunks[i].tokens), reverse=True):
+        if i not in picked and chunks[i].tokens <= tokens_left:
+            pick(i)
+
+    # put the picked chunks back together in order
+    indices: dict[int, list[int]] = {}
+
+    for i in sorted(picked, key=lambda i: (chunks[i].source, chunks[i].indices.start)):
+        indices.setdefault(chunks[i].source, []).extend(chunks[i].indices)
+
+    return [documents[source].select(indices[source]) for source in sorted(indices)]
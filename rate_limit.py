@@ -0,0 +1,71 @@
+'''
+Module containing a token bucket rate limiter, used to keep OpenAI queries under the tokens per minute limit
+'''
+
+import time
+from threading import Condition
+
+from constants import MAX_TOKENS_PER_MINUTE
+
+
+
+class TokenBucket:
+    '''
+    A bucket that holds up to `tokens_per_minute` tokens and refills at `tokens_per_minute` tokens per minute.
+
+    Callers take an estimate of the tokens they will use with `acquire`, waiting until there are enough, then correct it with `settle` once the real usage is known.
+
+    Safe to use from many threads at once.
+    '''
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated', 'condition')
+
+    def __init__(self, tokens_per_minute: int) -> None:
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.condition = Condition()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: int) -> None:
+        '''
+        Waits until there are `tokens` tokens in the bucket, then takes them.
+
+        Requests bigger than the bucket only wait for a full bucket.
+        '''
+
+        tokens = min(tokens, self.capacity)
+
+        with self.condition:
+            self._refill()
+
+            while self.tokens < tokens:
+                self.condition.wait((tokens - self.tokens) / self.rate)
+
+                self._refill()
+
+            self.tokens -= tokens
+
+    def settle(self, estimated: int, actual: int) -> None:
+        '''
+        Corrects an earlier `acquire(estimated)` once `actual` tokens are known to have been used.
+
+        Gives back what wasn't used, or takes what was used over the estimate (which can leave the bucket in debt).
+        '''
+
+        with self.condition:
+            self._refill()
+
+            self.tokens = min(self.capacity, self.tokens + min(estimated, self.capacity) - actual)
+
+            self.condition.notify_all()
+
+
+
+OPENAI_RATE_LIMITER = TokenBucket(MAX_TOKENS_PER_MINUTE)
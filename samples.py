@@ -0,0 +1,342 @@
+'''
+Module for keeping every sample GPT returns, so prices can be worked out again with different rules without paying for the queries again
+
+Samples are saved in chunks of columns (NumPy arrays in .npz files), with text columns stored as integer codes into a list of categories.
+
+Can be run from the command line to recompute every price:
+
+    python samples.py --statistic trimmed_mean --write
+'''
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import uuid
+from dataclasses import dataclass
+from threading import RLock
+from typing import Any, Iterable
+
+import numpy as np
+import numpy.typing as npt
+
+from constants import DATA_DIR, DATABASE_BACKEND, MAX_PRICE_PER_MINUTE, SAMPLE_FLUSH_EVERY, SAMPLE_TRIM
+
+
+
+SAMPLES_DIR = os.path.join(DATA_DIR, 'samples')
+
+TEXT_COLUMNS = ('city', 'treatment', 'provider', 'source')
+NUMBER_COLUMNS = ('duration', 'cost', 'package_count', 'timestamp')
+
+STATISTICS = ('mean', 'trimmed_mean', 'median')
+
+SampleRow = tuple[str, float, float, int, str] # (provider, duration, cost, package count, source url)
+
+IntArray = npt.NDArray[np.int64]
+FloatArray = npt.NDArray[np.float64]
+
+
+
+@dataclass(slots=True)
+class SampleColumns:
+    '''
+    Every saved sample as columns. Text columns are codes into `categories[column]`.
+    '''
+
+    codes: dict[str, IntArray]
+    categories: dict[str, list[str]]
+    numbers: dict[str, FloatArray]
+
+    def __len__(self) -> int:
+        return len(self.numbers['timestamp'])
+
+
+
+class SampleStore:
+    '''
+    Raw samples saved to `directory` as they come in.
+
+    Samples are kept in memory until there are `SAMPLE_FLUSH_EVERY` of them or `flush` is called, then written as a new chunk file. Safe to use from many threads at once.
+
+    Chunks are written while holding `lock`, so `compact` never sees a chunk that's half written or written after it listed the chunks.
+    '''
+
+    __slots__ = ('directory', 'rows', 'lock')
+
+    def __init__(self, directory: str = SAMPLES_DIR) -> None:
+        self.directory = directory
+        self.rows: list[tuple[str, str, str, str, float, float, int, float]] = []
+        self.lock = RLock()
+
+    def add(self, city: str, treatment: str, samples: Iterable[SampleRow]) -> None:
+        '''
+        Adds the samples from one reply about `treatment` in `city`. They all get the same timestamp, which marks them as one reply.
+        '''
+
+        timestamp = time.time()
+        rows = [(city, treatment, provider, source, duration, cost, package_count, timestamp) for provider, duration, cost, package_count, source in samples]
+
+        with self.lock:
+            self.rows.extend(rows)
+
+            if len(self.rows) >= SAMPLE_FLUSH_EVERY:
+                self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            rows, self.rows = self.rows, []
+
+            if rows:
+                self._write_chunk(rows)
+
+    def _write_chunk(self, rows: list[tuple[str, str, str, str, float, float, int, float]]) -> None:
+        arrays: dict[str, Any] = {}
+
+        for i, column in enumerate(TEXT_COLUMNS):
+            categories, codes = np.unique(np.array([row[i] for row in rows], dtype=np.str_), return_inverse=True)
+
+            arrays[f'{column}_categories'] = categories
+            arrays[column] = codes.astype(np.int32)
+
+        for i, column in enumerate(NUMBER_COLUMNS, len(TEXT_COLUMNS)):
+            arrays[column] = np.array([row[i] for row in rows], dtype=np.float64)
+
+        write_chunk(self.directory, arrays)
+
+    def load(self) -> SampleColumns:
+        '''
+        Returns every sample saved so far, including ones that haven't been flushed.
+        '''
+
+        self.flush()
+
+        return load_samples(self.directory)
+
+    def compact(self) -> None:
+        '''
+        Rewrites every chunk as one file, so loading doesn't have to open lots of small files.
+        '''
+
+        with self.lock:
+            self.flush()
+
+            paths = chunk_paths(self.directory)
+
+            if len(paths) < 2:
+                return
+
+            samples = load_samples(self.directory)
+
+            arrays: dict[str, Any] = {}
+
+            for column in TEXT_COLUMNS:
+                arrays[f'{column}_categories'] = np.array(samples.categories[column], dtype=np.str_)
+                arrays[column] = samples.codes[column].astype(np.int32)
+
+            arrays |= samples.numbers
+
+            write_chunk(self.directory, arrays)
+
+            for path in paths:
+                os.remove(path)
+
+
+
+def chunk_paths(directory: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(directory, 'samples_*.npz')))
+
+
+
+def write_chunk(directory: str, arrays: dict[str, Any]) -> None:
+    os.makedirs(directory, exist_ok=True)
+
+    name = f'samples_{time.strftime("%Y%m%d_%H%M%S")}_{uuid.uuid4().hex[:8]}.npz'
+
+    # written under a name `chunk_paths` doesn't match, so a half written chunk is never loaded
+    temp_path = os.path.join(directory, f'.tmp_{name}')
+
+    np.savez(temp_path, **arrays)
+
+    os.replace(temp_path, os.path.join(directory, name))
+
+
+
+def load_samples(directory: str = SAMPLES_DIR) -> SampleColumns:
+    '''
+    Loads every chunk in `directory` into one set of columns, with the codes of each chunk mapped to one shared list of categories for each text column.
+    '''
+
+    vocabularies: dict[str, dict[str, int]] = {column: {} for column in TEXT_COLUMNS}
+    codes: dict[str, list[IntArray]] = {column: [] for column in TEXT_COLUMNS}
+    numbers: dict[str, list[FloatArray]] = {column: [] for column in NUMBER_COLUMNS}
+
+    for path in chunk_paths(directory):
+        with np.load(path) as chunk:
+            for column in TEXT_COLUMNS:
+                vocabulary = vocabularies[column]
+                mapping = np.array([vocabulary.setdefault(str(name), len(vocabulary)) for name in chunk[f'{column}_categories']], dtype=np.int64)
+
+                codes[column].append(mapping[chunk[column]] if len(mapping) else np.empty(0, dtype=np.int64))
+
+            for column in NUMBER_COLUMNS:
+                numbers[column].append(chunk[column])
+
+    return SampleColumns(
+        {column: np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64) for column, arrays in codes.items()},
+        {column: list(vocabulary) for column, vocabulary in vocabularies.items()},
+        {column: np.concatenate(arrays) if arrays else np.empty(0) for column, arrays in numbers.items()},
+    )
+
+
+
+@dataclass(slots=True)
+class Aggregates:
+    '''
+    The price per minute statistics of every city and treatment with saved samples, one entry in each array per (`cities[i]`, `treatments[i]`).
+
+    `counts` is the number of samples used. Statistics are NaN where there are none.
+    '''
+
+    cities: list[str]
+    treatments: list[str]
+    counts: IntArray
+    mean: FloatArray
+    trimmed_mean: FloatArray
+    median: FloatArray
+
+    def rows(self) -> list[dict[str, Any]]:
+        '''
+        Returns a dict for each city and treatment, with `None` for statistics without samples.
+        '''
+
+        return [
+            {
+                'city': city,
+                'treatment': treatment,
+                'count': int(self.counts[i]),
+            } | {
+                statistic: float(getattr(self, statistic)[i]) if self.counts[i] else None for statistic in STATISTICS
+            }
+            for i, (city, treatment) in enumerate(zip(self.cities, self.treatments))
+        ]
+
+    def write_to(self, database: Any, statistic: str = 'mean') -> int:
+        '''
+        Saves `statistic` ('mean', 'trimmed_mean' or 'median') of every city and treatment with samples as its price in `database`. Returns how many prices were saved.
+        '''
+
+        values = getattr(self, statistic)
+        written = 0
+
+        for city, treatment, count, value in zip(self.cities, self.treatments, self.counts, values):
+            if count:
+                database.set_price(city, treatment, round(float(value), 2))
+                written += 1
+
+        database.save()
+
+        return written
+
+
+
+def recompute(samples: SampleColumns, latest_only: bool = True, trim: float = SAMPLE_TRIM, max_price_per_minute: float = MAX_PRICE_PER_MINUTE) -> Aggregates:
+    '''
+    Works out the price per minute statistics of every city and treatment from all of the samples at once.
+
+    Samples without a duration or package count, or over `max_price_per_minute`, are left out.
+    If `latest_only` is set, only the most recent reply for each city and treatment is used, like the saved prices. Otherwise every reply is pooled.
+    The trimmed mean drops the `trim` fraction of lowest and highest samples of each city and treatment.
+    '''
+
+    duration = samples.numbers['duration']
+    package_count = samples.numbers['package_count']
+
+    # group by city and treatment
+    treatment_count = max(1, len(samples.categories['treatment']))
+    keys = samples.codes['city'] * treatment_count + samples.codes['treatment']
+    group_keys, groups = np.unique(keys, return_inverse=True)
+    group_count = len(group_keys)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ppms = samples.numbers['cost'] / duration / package_count
+
+    keep = (duration > 0) & (package_count > 0) & (ppms <= max_price_per_minute)
+
+    if latest_only:
+        latest = np.full(group_count, -np.inf)
+        np.maximum.at(latest, groups, samples.numbers['timestamp'])
+
+        keep &= samples.numbers['timestamp'] == latest[groups]
+
+    groups = groups[keep]
+    ppms = ppms[keep]
+
+    counts = np.bincount(groups, minlength=group_count)
+    has_samples = counts > 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(groups, weights=ppms, minlength=group_count) / counts
+
+    # sorted by group then price per minute, so each group is a sorted run starting at `starts`
+    order = np.lexsort((ppms, groups))
+    sorted_ppms = ppms[order]
+    starts = np.cumsum(counts) - counts
+
+    median = np.full(group_count, np.nan)
+    median[has_samples] = 0.5 * (sorted_ppms[(starts + (counts - 1) // 2)[has_samples]] + sorted_ppms[(starts + counts // 2)[has_samples]])
+
+    # the position of each sample within its group's sorted run
+    sorted_groups = groups[order]
+    ranks = np.arange(len(sorted_ppms)) - starts[sorted_groups]
+    cut = np.floor(counts * trim).astype(np.int64)
+
+    inside = (ranks >= cut[sorted_groups]) & (ranks < (counts - cut)[sorted_groups])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trimmed_mean = np.bincount(sorted_groups[inside], weights=sorted_ppms[inside], minlength=group_count) / np.bincount(sorted_groups[inside], minlength=group_count)
+
+    cities = samples.categories['city']
+    treatments = samples.categories['treatment']
+
+    return Aggregates(
+        [cities[key // treatment_count] for key in group_keys],
+        [treatments[key % treatment_count] for key in group_keys],
+        counts,
+        mean,
+        trimmed_mean,
+        median,
+    )
+
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Recompute the price per minute of every city and treatment from the saved GPT samples.')
+    parser.add_argument('--statistic', choices=STATISTICS, default='mean', help='which statistic to save as the price')
+    parser.add_argument('--all-replies', action='store_true', help='pool every reply for each city and treatment, instead of only the latest')
+    parser.add_argument('--trim', type=float, default=SAMPLE_TRIM, help='fraction of the lowest and highest samples the trimmed mean drops')
+    parser.add_argument('--write', action='store_true', help='save the recomputed prices to the database')
+    parser.add_argument('--database', choices=('sqlite', 'json'), default=DATABASE_BACKEND, help='where saved prices are kept')
+
+    args = parser.parse_args(argv)
+
+    aggregates = recompute(load_samples(), not args.all_replies, args.trim)
+
+    for row in aggregates.rows():
+        print(json.dumps(row))
+
+    if args.write:
+        import database
+
+        written = aggregates.write_to(database.load(args.database), args.statistic)
+
+        print(f'Saved {written} prices', file=sys.stderr)
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
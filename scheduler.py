@@ -0,0 +1,130 @@
+'''
+Module containing the long lived worker pools for each stage of getting prices (searching, fetching pages, parsing pages and querying GPT)
+'''
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Iterable, TypeVar
+
+from constants import PARSE_PROCESSES, STAGE_WORKERS
+
+
+
+T = TypeVar('T')
+
+
+
+class Stage:
+    '''
+    A fixed number of worker threads shared by everything that runs one stage of the pipeline.
+
+    Work waits in a queue until a worker is free, so overlapping requests never run more than `workers` at once.
+    '''
+
+    __slots__ = ('name', 'workers', 'executor')
+
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def submit(self, func: Callable[..., T], *args: Any) -> Future[T]:
+        return self.executor.submit(func, *args)
+
+    def run(self, func: Callable[..., T], *args: Any) -> T:
+        '''
+        Runs `func` on one of the stage's workers and waits for the result.
+        '''
+
+        return self.executor.submit(func, *args).result()
+
+    def map(self, func: Callable[..., T], *iterables: Iterable[Any]) -> list[T]:
+        '''
+        Runs `func` over `iterables` on the stage's workers and returns the results in order.
+        '''
+
+        return list(self.executor.map(func, *iterables))
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+
+_stages: dict[str, Stage] = {}
+_lock = Lock()
+
+_process_pool: ProcessPoolExecutor | None = None
+_process_workers = PARSE_PROCESSES
+
+
+
+def get_stage(name: str) -> Stage:
+    '''
+    Returns the shared stage called `name`, creating it with `STAGE_WORKERS[name]` workers if it doesn't exist yet.
+    '''
+
+    with _lock:
+        if name not in _stages:
+            _stages[name] = Stage(name, STAGE_WORKERS[name])
+
+        return _stages[name]
+
+
+
+def configure_stages(workers: dict[str, int]) -> None:
+    '''
+    Sets the number of workers of each stage in `workers`.
+
+    Stages that already exist with a different number of workers are replaced. Work already queued on them still finishes.
+    '''
+
+    with _lock:
+        for name, count in workers.items():
+            if name in _stages:
+                if _stages[name].workers == count:
+                    continue
+
+                _stages[name].executor.shutdown(wait=False)
+
+            _stages[name] = Stage(name, count)
+
+
+
+def get_process_pool() -> ProcessPoolExecutor | None:
+    '''
+    Returns the shared pool of processes for parsing web pages, or `None` if parsing should stay on the calling thread.
+
+    The pool is started the first time it is needed.
+    '''
+
+    global _process_pool
+
+    with _lock:
+        if _process_pool is None and _process_workers > 0:
+            _process_pool = ProcessPoolExecutor(max_workers=_process_workers)
+
+        return _process_pool
+
+
+
+def get_process_pool_size() -> int:
+    return _process_workers
+
+
+
+def configure_process_pool(workers: int) -> None:
+    '''
+    Sets the number of processes used to parse web pages. 0 turns the process pool off.
+    '''
+
+    global _process_pool, _process_workers
+
+    with _lock:
+        if workers == _process_workers:
+            return
+
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False)
+
+        _process_pool = None
+        _process_workers = workers
@@ -0,0 +1,48 @@
+'''
+Module for sharing one in-flight call between every thread that asks for the same thing at the same time
+'''
+
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any, Callable, Hashable, TypeVar
+
+
+
+T = TypeVar('T')
+
+
+
+class SingleFlight:
+    '''
+    Makes sure only one call for each key runs at a time.
+
+    Threads that ask for a key while a call for it is running wait for that call and get the same result (or exception) instead of making their own.
+    Once the call finishes, the next request for the key starts a new call.
+    '''
+
+    __slots__ = ('calls', 'lock')
+
+    def __init__(self) -> None:
+        self.calls: dict[Hashable, Future] = {}
+        self.lock = Lock()
+
+    def do(self, key: Hashable, func: Callable[..., T], *args: Any) -> T:
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+
+            if leader:
+                future = self.calls[key] = Future()
+
+        if not leader:
+            return future.result() # type: ignore
+
+        try:
+            future.set_result(func(*args)) # type: ignore
+        except BaseException as exception:
+            future.set_exception(exception) # type: ignore
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+        return future.result() # type: ignore
@@ -0,0 +1,209 @@
+'''
+Module containing a spatial index over the coordinates of every zip code, for finding zip codes within some distance of a point or nearest to it
+'''
+
+from threading import Lock
+import math
+import os
+
+import numpy as np
+import numpy.typing as npt
+
+from cache import CACHE_DIR
+from zipcode import get_zip_index, index_version
+
+
+
+ZIP_GRID_PATH = os.path.join(CACHE_DIR, 'zip_grid.npz')
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE = math.pi * EARTH_RADIUS_MILES / 180
+
+CELL_DEGREES = 0.5 # width and height of each grid cell
+ROWS = math.ceil(180 / CELL_DEGREES)
+COLUMNS = math.ceil(360 / CELL_DEGREES)
+
+FloatArray = npt.NDArray[np.float64]
+
+
+
+def haversine(lat: float, long: float, lats: FloatArray, longs: FloatArray) -> FloatArray:
+    '''
+    Returns the great circle distance in miles from (`lat`, `long`) to each point in `lats` and `longs` (all in degrees).
+    '''
+
+    lat_1 = math.radians(lat)
+    lat_2 = np.radians(lats)
+
+    a = np.sin((lat_2 - lat_1) * 0.5) ** 2 + math.cos(lat_1) * np.cos(lat_2) * np.sin(np.radians(longs - long) * 0.5) ** 2
+
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+
+def _cells(lats: FloatArray, longs: FloatArray) -> npt.NDArray[np.int64]:
+    rows = np.clip(((lats + 90) // CELL_DEGREES).astype(np.int64), 0, ROWS - 1)
+    columns = ((longs + 180) // CELL_DEGREES).astype(np.int64) % COLUMNS
+
+    return rows * COLUMNS + columns
+
+
+
+class ZipGrid:
+    '''
+    The coordinates of every zip code, bucketed into a grid of `CELL_DEGREES` cells.
+
+    Points are sorted by cell, so each cell's points are one slice of the arrays, found from `cell_starts`.
+    A query only measures the distance to points in the cells that overlap its search area.
+    '''
+
+    __slots__ = ('zipcodes', 'lats', 'longs', 'cell_starts')
+
+    def __init__(self, zip_codes: npt.NDArray[np.str_], lats: FloatArray, longs: FloatArray) -> None:
+        cells = _cells(lats, longs)
+        order = np.argsort(cells, kind='stable')
+
+        self.zipcodes = zip_codes[order]
+        self.lats = lats[order]
+        self.longs = longs[order]
+
+        # the points in cell `i` are `cell_starts[i]:cell_starts[i + 1]`
+        self.cell_starts = np.searchsorted(cells[order], np.arange(ROWS * COLUMNS + 1))
+
+    @classmethod
+    def build(cls) -> 'ZipGrid':
+        records = get_zip_index().records.values()
+
+        return cls(
+            np.array([record['zip_code'] for record in records]),
+            np.array([float(record['lat']) for record in records]),
+            np.array([float(record['long']) for record in records]),
+        )
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # np.savez adds .npz to names without it
+        temp_path = path[:-len('.npz')] + '.tmp.npz'
+
+        np.savez(temp_path, version=index_version(), zipcodes=self.zipcodes, lats=self.lats, longs=self.longs, cell_starts=self.cell_starts)
+
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ZipGrid | None':
+        '''
+        Loads a grid saved with `save()`. Returns `None` if there isn't one, or it's from a different zip code index or grid size.
+        '''
+
+        try:
+            with np.load(path) as data:
+                if str(data['version']) != index_version() or len(data['cell_starts']) != ROWS * COLUMNS + 1:
+                    return None
+
+                grid = cls.__new__(cls)
+
+                grid.zipcodes = data['zipcodes']
+                grid.lats = data['lats']
+                grid.longs = data['longs']
+                grid.cell_starts = data['cell_starts']
+
+                return grid
+
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _candidates(self, lat: float, long: float, miles: float) -> npt.NDArray[np.int64]:
+        '''
+        Returns the indices of every point in a cell that overlaps the box around the circle of `miles` around (`lat`, `long`).
+        '''
+
+        lat_span = miles / MILES_PER_DEGREE
+
+        min_row = max(0, int((lat - lat_span + 90) // CELL_DEGREES))
+        max_row = min(ROWS - 1, int((lat + lat_span + 90) // CELL_DEGREES))
+
+        # lines of longitude get closer together away from the equator, so the box is widest at the edge closest to a pole
+        widest_lat = min(90.0, abs(lat) + lat_span)
+        cos_lat = math.cos(math.radians(widest_lat))
+        long_span = 360.0 if cos_lat < 1e-6 else miles / (MILES_PER_DEGREE * cos_lat)
+
+        if long_span >= 180:
+            columns = np.arange(COLUMNS)
+        else:
+            min_column = int((long - long_span + 180) // CELL_DEGREES)
+            max_column = int((long + long_span + 180) // CELL_DEGREES)
+
+            columns = np.unique(np.arange(min_column, max_column + 1) % COLUMNS)
+
+        cells = (np.arange(min_row, max_row + 1)[:, None] * COLUMNS + columns[None, :]).ravel()
+
+        starts = self.cell_starts[cells]
+        ends = self.cell_starts[cells + 1]
+        counts = ends - starts
+
+        if not counts.sum():
+            return np.empty(0, dtype=np.int64)
+
+        # all of the ranges starts[i]:ends[i] joined together
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+
+        return offsets + np.arange(counts.sum())
+
+    def within(self, lat: float, long: float, miles: float) -> tuple[npt.NDArray[np.str_], FloatArray]:
+        '''
+        Returns the zip codes within `miles` miles of (`lat`, `long`) and their distances, closest first.
+        '''
+
+        candidates = self._candidates(lat, long, miles)
+        distances = haversine(lat, long, self.lats[candidates], self.longs[candidates])
+
+        inside = distances <= miles
+        candidates = candidates[inside]
+        distances = distances[inside]
+
+        order = np.argsort(distances, kind='stable')
+
+        return self.zipcodes[candidates[order]], distances[order]
+
+    def nearest(self, lat: float, long: float, k: int) -> tuple[npt.NDArray[np.str_], FloatArray]:
+        '''
+        Returns the `k` zip codes closest to (`lat`, `long`) and their distances, closest first.
+
+        Searches a growing radius until it holds at least `k` points, which must include the `k` closest.
+        '''
+
+        k = min(k, len(self.zipcodes))
+        miles = CELL_DEGREES * MILES_PER_DEGREE
+
+        while True:
+            zip_codes, distances = self.within(lat, long, miles)
+
+            if len(zip_codes) >= k or miles > math.pi * EARTH_RADIUS_MILES:
+                return zip_codes[:k], distances[:k]
+
+            miles *= 2
+
+
+
+_grid: ZipGrid | None = None
+_grid_lock = Lock()
+
+
+
+def get_zip_grid() -> ZipGrid:
+    '''
+    Returns the shared zip code grid, loading it from `ZIP_GRID_PATH` or building and saving it the first time.
+    '''
+
+    global _grid
+
+    with _grid_lock:
+        if _grid is None:
+            _grid = ZipGrid.load(ZIP_GRID_PATH)
+
+            if _grid is None:
+                _grid = ZipGrid.build()
+                _grid.save(ZIP_GRID_PATH)
+
+        return _grid
@@ -0,0 +1,31 @@
+'''
+Module for reporting how long the program took to start, and which of the slow to import libraries were loaded before it was ready
+'''
+
+import sys
+import time
+
+
+
+STARTED = time.perf_counter()
+
+# libraries that take a while to import, and should only be loaded once they're needed
+HEAVY_MODULES = ('numpy', 'openai', 'pydantic', 'requests', 'tiktoken', 'zipcodes')
+
+
+
+def report_startup(name: str) -> float:
+    '''
+    Logs the seconds since this module was imported and which of `HEAVY_MODULES` have been imported so far, then returns the seconds.
+
+    For a full breakdown of import times, run with `python -X importtime`.
+    '''
+
+    from log import log
+
+    elapsed = time.perf_counter() - STARTED
+    loaded = [module for module in HEAVY_MODULES if module in sys.modules]
+
+    log(f'{name} ready after {elapsed:.3f}s, heavy modules loaded: {", ".join(loaded) or "none"}\n', 'startup.txt')
+
+    return elapsed
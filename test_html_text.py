@@ -0,0 +1,29 @@
+import html_text
+from html_text import html_to_text
+
+
+
+def test_text_split_across_feed_chunks(monkeypatch):
+    monkeypatch.setattr(html_text, 'FEED_SIZE', 7)
+
+    body = b'<html><body><p>Massage sixty minutes costs $120 today</p><script>var x = 1;</script><p>Facial &amp; peel</p></body></html>'
+
+    assert html_to_text(body, 'utf-8') == 'Massage sixty minutes costs $120 today\nFacial & peel'
+
+
+
+def test_text_split_inside_multibyte_character(monkeypatch):
+    monkeypatch.setattr(html_text, 'FEED_SIZE', 3)
+
+    body = '<p>Café massage — $80</p><p>next</p>'.encode('utf-8')
+
+    assert html_to_text(body, 'utf-8') == 'Café massage — $80\nnext'
+
+
+
+def test_unclosed_skipped_tag_keeps_the_rest_of_the_page():
+    assert html_to_text(b'<nav><a>Home</a><p>Massage 60 min $90</p>', 'utf-8') == 'Home\nMassage 60 min $90'
+
+    body = b'<body><div><nav><a>Home</a></div><p>Facial $50</p><nav>Menu</nav><script>var x = "</p>";</script></body>'
+
+    assert html_to_text(body, 'utf-8') == 'Home\nFacial $50'
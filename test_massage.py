@@ -0,0 +1,81 @@
+import math
+import random
+from statistics import median
+
+import numpy as np
+
+from massage import Listing, aggregate_prices, listing_arrays
+
+
+
+def loop_prices(listings: list[Listing], durations: list[int], max_dist: float) -> dict[int, tuple[float, int]]:
+    '''
+    The one zip code at a time loop `aggregate_prices` replaced, returning the price and sample count of each duration with samples.
+    '''
+
+    time_cost: dict[int, list[float]] = {}
+
+    for listing in listings:
+        if listing.distance <= max_dist:
+            time_cost.setdefault(listing.duration, []).append(listing.price)
+
+    prices: dict[int, tuple[float, int]] = {}
+
+    for duration in durations:
+        ppms: list[float] = []
+        variance = 5 * round(duration ** 0.5 / 5)
+
+        for time in time_cost:
+            if abs(time - duration) <= variance:
+                ppms.extend(price / time for price in time_cost[time])
+
+        if not ppms:
+            continue
+
+        med = median(ppms)
+        no_outliers = [ppm for ppm in ppms if 0.5 < abs(ppm / med) < 2]
+
+        if no_outliers:
+            prices[duration] = (sum(no_outliers) / len(no_outliers) * duration, len(no_outliers))
+
+    return prices
+
+
+
+def random_listings(rng: random.Random) -> list[Listing]:
+    return [
+        Listing(round(rng.uniform(0, 30), 1), rng.choice((30, 45, 50, 60, 75, 80, 90, 120)), float(rng.randint(20, 300)))
+        for _ in range(rng.randint(0, 40))
+    ]
+
+
+
+def test_matches_the_old_loop():
+    rng = random.Random(0)
+    durations = [30, 60, 90, 120]
+
+    for _ in range(200):
+        listings = [random_listings(rng) for _ in range(rng.randint(1, 5))]
+        max_dists = [rng.uniform(0, 30) for _ in listings]
+
+        prices, counts = aggregate_prices(*listing_arrays(listings), len(listings), durations, np.array(max_dists))
+
+        for i, (zip_listings, max_dist) in enumerate(zip(listings, max_dists)):
+            expected = loop_prices(zip_listings, durations, max_dist)
+
+            for j, duration in enumerate(durations):
+                if duration in expected:
+                    assert math.isclose(prices[i, j], expected[duration][0])
+                    assert counts[i, j] == expected[duration][1]
+                else:
+                    assert math.isnan(prices[i, j])
+                    assert counts[i, j] == 0
+
+
+
+def test_no_listings():
+    prices, counts = aggregate_prices(*listing_arrays([[], []]), 2, [60, 90], 10.0)
+
+    assert prices.shape == counts.shape == (2, 2)
+    assert np.isnan(prices).all()
+    assert not counts.any()
@@ -0,0 +1,78 @@
+import math
+
+import numpy as np
+
+import samples as samples_module
+from samples import SampleStore, load_samples, recompute
+
+
+
+def hand_built_store(tmp_path, monkeypatch) -> SampleStore:
+    # each reply gets the next timestamp
+    timestamps = iter(range(1, 100))
+    monkeypatch.setattr(samples_module.time, 'time', lambda: float(next(timestamps)))
+
+    store = SampleStore(str(tmp_path))
+
+    # an old reply, then a newer one that replaces it when only the latest is used
+    store.add('Denver, CO', 'Massage', [('a', 60, 60.0, 1, 'u'), ('b', 60, 120.0, 1, 'u')])
+    store.add('Denver, CO', 'Massage', [('c', 60, 60.0, 1, 'u'), ('d', 60, 90.0, 1, 'u'), ('e', 60, 120.0, 1, 'u'), ('f', 60, 600.0, 1, 'u')])
+
+    # every sample filtered out: no duration, no package count, or too expensive
+    store.add('Boulder, CO', 'Facial', [('g', 0, 50.0, 1, 'u'), ('h', 30, 50.0, 0, 'u'), ('i', 1, 10000.0, 1, 'u')])
+
+    store.flush()
+    monkeypatch.undo()
+
+    return store
+
+
+
+def aggregate_rows(aggregates) -> dict[tuple[str, str], dict]:
+    return {(row['city'], row['treatment']): row for row in aggregates.rows()}
+
+
+
+def test_latest_only_and_trimmed_mean(tmp_path, monkeypatch):
+    samples = load_samples(hand_built_store(tmp_path, monkeypatch).directory)
+
+    latest = aggregate_rows(recompute(samples, latest_only=True, trim=0.25, max_price_per_minute=5.0))
+    denver = latest[('Denver, CO', 'Massage')]
+
+    # 600 / 60 is over the limit, leaving 1, 1.5 and 2 per minute
+    assert denver['count'] == 3
+    assert math.isclose(denver['mean'], 1.5)
+    assert math.isclose(denver['median'], 1.5)
+    # floor(3 * 0.25) = 0 samples trimmed from each end
+    assert math.isclose(denver['trimmed_mean'], 1.5)
+
+    pooled = aggregate_rows(recompute(samples, latest_only=False, trim=0.25, max_price_per_minute=10.0))
+    denver = pooled[('Denver, CO', 'Massage')]
+
+    # 1, 2, 1, 1.5, 2, 10 per minute, and the trimmed mean drops 1 and 10
+    assert denver['count'] == 6
+    assert math.isclose(denver['mean'], 17.5 / 6)
+    assert math.isclose(denver['median'], 1.75)
+    assert math.isclose(denver['trimmed_mean'], 6.5 / 4)
+
+
+
+def test_all_samples_filtered(tmp_path, monkeypatch):
+    samples = load_samples(hand_built_store(tmp_path, monkeypatch).directory)
+
+    boulder = aggregate_rows(recompute(samples, max_price_per_minute=5.0))[('Boulder, CO', 'Facial')]
+
+    assert boulder == {'city': 'Boulder, CO', 'treatment': 'Facial', 'count': 0, 'mean': None, 'trimmed_mean': None, 'median': None}
+
+
+
+def test_no_samples(tmp_path):
+    samples = load_samples(str(tmp_path))
+
+    assert len(samples) == 0
+
+    aggregates = recompute(samples)
+
+    assert aggregates.rows() == []
+    assert len(aggregates.counts) == 0
+    assert np.array_equal(aggregates.mean, np.empty(0))
@@ -116,3 +116,13 @@ class Facial(Treatment):
 
 TREATMENTS: tuple[Treatment, ...] = (VibroacousticTherapy, PEMF, RedLightTherapy, Hocatt, HyperbaricOxygenTherapy, EES, InfraredSauna, Facial) # type: ignore
 
+TREATMENTS_BY_NAME: dict[str, Treatment] = {treatment.name.lower(): treatment for treatment in TREATMENTS}
+
+
+
+def get_treatment(name: str) -> Treatment:
+    '''
+    Returns the treatment called `name` (case insensitive). Raises a `KeyError` if there isn't one.
+    '''
+
+    return TREATMENTS_BY_NAME[name.strip().lower()]
@@ -2,13 +2,22 @@
 Module conatining functions to scrape the web, including search and url parsing
 '''
 
+import json
+import re
+import time
 from collections import deque
+from functools import lru_cache
 
-from bs4 import BeautifulSoup
-import requests
-
+import http_session
+from cache import DiskCache, JsonCache, hash_key
 from constants import *
+from dedupe import remove_near_duplicates
+from document import Document, PackedDocument
+from ranking import select_chunks
+from html_text import detect_encoding, html_to_text
 from log import log
+from scheduler import get_stage, get_process_pool, get_process_pool_size
+from singleflight import SingleFlight
 
 
 
@@ -17,15 +26,38 @@ HEADERS = {
     'Accept-Language': 'en-US,en;q=0.9'
 }
 
+PAGE_CACHE = DiskCache('pages', PAGE_CACHE_MAX_BYTES)
+SEARCH_CACHE = JsonCache('searches')
+
+# calls currently running, shared with any thread that makes the same call
+_searches = SingleFlight()
+_pages = SingleFlight()
+_documents = SingleFlight()
+
 
 
 def search(query: str, num_urls: int, page: int = 1) -> list[str]:
     '''
     Searches google for `query` and returns `num_urls` urls.
 
-    Uses Google's Custom Search Engine.
+    Uses Google's Custom Search Engine. Results are cached for `SEARCH_CACHE_TTL` seconds, or `SEARCH_CACHE_FAILED_TTL` seconds if the search failed or found nothing.
+
+    Threads running the same search at the same time share one request.
     '''
 
+    return _searches.do((query, num_urls, page), _search, query, num_urls, page)
+
+
+
+def _search(query: str, num_urls: int, page: int) -> list[str]:
+    cache_key = json.dumps([query, num_urls, page])
+    cached_urls = SEARCH_CACHE.get(cache_key)
+
+    if cached_urls is not None:
+        log(f'{query} (cached, {SEARCH_CACHE.hits} hits and {SEARCH_CACHE.misses} misses)\n\n', 'searches.txt')
+
+        return cached_urls
+
     url = 'https://www.googleapis.com/customsearch/v1'
     base_params = {
         'key': CUSTOM_SEARCH_API_KEY,
@@ -41,7 +73,7 @@ def search(query: str, num_urls: int, page: int = 1) -> list[str]:
             'start': page
         }
 
-        response = requests.get(url, params=params, headers=HEADERS)
+        response = http_session.get(url, params=params, headers=HEADERS)
 
         if response.status_code == 200:
             results = response.json()
@@ -56,52 +88,51 @@ def search(query: str, num_urls: int, page: int = 1) -> list[str]:
         else:
             log(f'Search failed: error code {response.status_code} {response.reason}', 'searches.txt')
 
+            SEARCH_CACHE.put(cache_key, [], SEARCH_CACHE_FAILED_TTL)
+
             return []
 
     log(f'{query}\n - {'\n - '.join(urls)}\n\n', 'searches.txt')
 
+    SEARCH_CACHE.put(cache_key, urls, SEARCH_CACHE_TTL if urls else SEARCH_CACHE_FAILED_TTL)
+
     return urls
 
 
 
-def get_search_data(search_term: str, keywords: dict[str, int], min_pages: int) -> list[str]:
-    '''
-    Return `get_website_price_data()` for each url when `search_term` is searched.
+def get_search_data(search_term: str, keywords: dict[str, int], min_pages: int, max_tokens: int = MAX_INPUT_TOKENS_PER_QUERY - 250) -> list[Document]:
     '''
+    Return the most relevant parts of `get_website_document()` for each url when `search_term` is searched.
 
-    urls = search(search_term, 10)
+    All of the urls are fetched concurrently on the fetch stage and near duplicate chunks are removed across pages.
+    Then chunks from every page are scored for pricing information, and the best are packed into `max_tokens` tokens, with at least one chunk from each of the first `min_pages` relevant pages.
+    '''
 
-    output = []
-    tokens_left = MAX_INPUT_TOKENS_PER_QUERY - 250
-    pages_left = min_pages
-    page_token_limit = int(tokens_left * pages_left ** -0.75)
+    urls = get_stage('search').run(search, search_term, 10)
 
-    for url in urls:
-        price_data = get_website_data(url, keywords, 1)
+    if not urls:
+        return []
 
-        token_ids = GPT_ENCODING.encode(price_data)
-        tokens = len(token_ids)
+    # fetch every page at once, so the wait is about as long as the slowest page
+    process_pool = get_process_pool()
 
-        # skip if there are no tokens
-        if tokens == 0:
-            continue
+    if process_pool is None:
+        pages = get_stage('fetch').map(lambda url: get_website_document(url, keywords, 1), urls)
 
-        # clamp the tokens if there are too many
-        if tokens > page_token_limit:
-            price_data = GPT_ENCODING.decode(token_ids[:page_token_limit])
+    else:
+        # only download on the threads, and parse on every core
+        raw_pages = get_stage('fetch').map(fetch_page, urls)
 
-        # add the source
-        output.append(price_data)
+        jobs = [(url, *page, keywords, 1) for url, page in zip(urls, raw_pages) if page is not None]
+        chunksize = max(1, len(jobs) // (4 * get_process_pool_size()))
 
-        tokens_left -= min(tokens, page_token_limit)
-        pages_left = max(1, pages_left - 1)
-        page_token_limit = int(tokens_left * pages_left ** -0.75)
+        pages = [Document.unpack(packed) for packed in process_pool.map(process_page, jobs, chunksize=chunksize)]
 
-        # end if max_tokens is reached
-        if tokens_left <= 0:
-            break
+    # don't pay for the same content twice
+    pages = remove_near_duplicates(pages)
 
-    return output
+    # send the chunks with the most pricing information that fit in the budget
+    return select_chunks(pages, keywords, max_tokens, min_pages)
 
 
 
@@ -110,83 +141,221 @@ def get_website_data(url: str, keywords: dict[str, int], duplicate_dist: int) ->
     Return the text contained in a website url.
     '''
 
+    return get_website_document(url, keywords, duplicate_dist).text
+
+
+
+def get_website_document(url: str, keywords: dict[str, int], duplicate_dist: int) -> Document:
+    '''
+    Return the text contained in a website url as a tokenized document.
+
+    Threads asking for the same page with the same keywords at the same time share one download and parse.
+    '''
+
+    key = (url, tuple(sorted(keywords.items())), duplicate_dist)
+
+    return _documents.do(key, _get_website_document, url, keywords, duplicate_dist)
+
+
+
+def _get_website_document(url: str, keywords: dict[str, int], duplicate_dist: int) -> Document:
+    page = fetch_page(url)
+
+    if page is None:
+        return Document([], [], url)
+
+    document = extract_keywords(html_to_text(*page), keywords, duplicate_dist)
+    document.url = url
+
+    return document
+
+
+
+def process_page(job: tuple[str, bytes, str, dict[str, int], int]) -> PackedDocument:
+    '''
+    Turns the raw html of a page into a packed tokenized document. `job` is the url, html, encoding, keywords and duplicate distance.
+
+    Runs in a worker process, so it only takes and returns things that are quick to pickle.
+    '''
+
+    url, body, encoding, keywords, duplicate_dist = job
+
+    document = extract_keywords(html_to_text(body, encoding), keywords, duplicate_dist)
+    document.url = url
+
+    return document.pack()
+
+
+
+def fetch_page(url: str) -> tuple[bytes, str] | None:
+    '''
+    Return the html of a website url and its encoding, or `None` if it couldn't be accessed.
+
+    Only the first `MAX_PAGE_BYTES` bytes of a page are downloaded.
+
+    Pages are cached on disk. Cached pages are used as is for `PAGE_CACHE_TTL` seconds, then revalidated with a conditional request.
+
+    Threads fetching the same url at the same time share one request.
+    '''
+
+    return _pages.do(url, _fetch_page, url)
+
+
+
+def _fetch_page(url: str) -> tuple[bytes, str] | None:
+    key = hash_key(url)
+    cached = PAGE_CACHE.get(key)
+    headers = HEADERS
+
+    if cached is not None:
+        metadata, body = cached
+
+        if time.time() - metadata['fetched'] < PAGE_CACHE_TTL:
+            return body, metadata['encoding']
+
+        # ask the server to only send the page if it changed
+        headers = HEADERS.copy()
+
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+
+        if metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
+
     try:
-        response = requests.get(url, headers=HEADERS, timeout=5)
+        response, content, truncated = http_session.get_capped(url, MAX_PAGE_BYTES, headers=headers, timeout=5)
     except:
-        return ''
+        # use the old page if it can't be revalidated
+        if cached is not None:
+            return body, metadata['encoding']
+
+        return None
 
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.text, 'html.parser')
+    if response.status_code == 304 and cached is not None:
+        metadata['fetched'] = time.time()
+        PAGE_CACHE.update_metadata(key, metadata)
+
+        return body, metadata['encoding']
+
+    elif response.status_code == 200:
+        if truncated:
+            log(f'Website cut off after {MAX_PAGE_BYTES} bytes: {url}\n', 'searches.txt')
+
+        encoding = detect_encoding(response.headers.get('Content-Type'), content)
+
+        metadata = {
+            'url': url,
+            'fetched': time.time(),
+            'encoding': encoding,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
 
-        return extract_keywords(soup.get_text(separator='\n', strip=True), keywords, duplicate_dist)
+        PAGE_CACHE.put(key, metadata, content)
+
+        return content, encoding
 
     else:
         log(f'Website access failed: error code {response.status_code} {response.reason}', 'searches.txt')
 
-        return ''
+        return None
 
 
 
-def extract_keywords(text: str, keywords: dict[str, int], duplicate_dist: int) -> str:
+def extract_keywords(text: str, keywords: dict[str, int], duplicate_dist: int) -> Document:
     '''
     Remove unnessecary whitespace and then extract the lines with `strings` keys in them, along with `strings` values surrounding lines.
     '''
 
-    # lowercase all of the strings for comparison
-    strings = {string.lower(): context for string, context in keywords.items()}
+    pattern, strings = compile_keywords(tuple(keywords.items()))
+
+    document = clean_text(text, duplicate_dist)
 
-    lines = clean_text(text, duplicate_dist).splitlines(keepends=True)
-    line_indices = set()
-    output = ''
+    if pattern is None:
+        return document.select([])
+
+    max_context = max(strings.values())
+    output: list[int] = []
+    end = -1 # the last line included by the context of a line already seen
 
     # get lines with money values in them (costs)
-    for i, line in enumerate(lines):
-        line_compare = line.lower()
+    for i, line in enumerate(document.lines):
         j = 0
 
-        # get the maximum context size to check
-        for string, context in strings.items():
-            j = max(j, context * (string in line_compare))
+        # get the maximum context size of the keywords in the line
+        for match in pattern.finditer(line):
+            j = max(j, strings[match.group(1).lower()])
+
+            if j == max_context:
+                break
 
         # add the lines and context
         if j:
-            line_indices.update(range(i - j, i + j + 1))
+            end = max(end, i + j)
+
+        if i <= end:
+            output.append(i)
+
+    return document.select(output)
+
+
 
-        if i in line_indices:
-            output += line
+@lru_cache(maxsize=64)
+def compile_keywords(keywords: tuple[tuple[str, int], ...]) -> tuple[re.Pattern[str] | None, dict[str, int]]:
+    '''
+    Returns a regex that finds every keyword in a line at once, and the context size of each lowercase keyword.
+
+    Keywords with more context are tried first, so the lookahead finds the biggest context at each position, even when keywords overlap.
+
+    Cached, so each set of keywords is only compiled once.
+    '''
+
+    # lowercase all of the strings for comparison
+    strings = {string.lower(): context for string, context in keywords if context > 0}
+
+    if not strings:
+        return None, strings
+
+    ordered = sorted(strings, key=lambda string: (-strings[string], -len(string)))
+    pattern = re.compile('(?=(' + '|'.join(map(re.escape, ordered)) + '))', re.IGNORECASE)
 
-    return output
+    return pattern, strings
 
 
 
-def clean_text(text: str, duplicate_dist: int) -> str:
+def clean_text(text: str, duplicate_dist: int) -> Document:
     '''
     Remove unnessecary whitespace, including empty indentations and leading and trailing spaces in each line.
 
     Also removes duplicate lines within `duplicate_lines` lines of the first one seen.
+
+    Each line is tokenized here, and the tokens are kept with it from then on.
     '''
 
-    output = ''
+    output: list[str] = []
+    output_tokens: list[list[int]] = []
     lines: deque[str] = deque(maxlen=duplicate_dist)
+    encoding = get_encoding()
 
     for line in text.splitlines(keepends=True):
         if line and not line.isspace():
             # remove all non-ascii characters from the line
-            ascii_line = ''.join(filter(str.isascii, line))
+            ascii_line = line.encode('ascii', 'ignore').decode('ascii')
 
             # clip line if it is over 100 tokens
-            tokens = GPT_ENCODING.encode(ascii_line)
+            tokens = encoding.encode(ascii_line)
 
             if len(tokens) > 100:
-                ascii_line = GPT_ENCODING.decode(tokens[:100])
+                tokens = tokens[:100]
+                ascii_line = encoding.decode(tokens)
 
             lowercase_line = ascii_line.lower()
 
             # skip if it is a duplicate
             if lowercase_line not in lines:
-                output += ascii_line
+                output.append(ascii_line)
+                output_tokens.append(tokens)
 
                 lines.append(lowercase_line)
 
-    return output
-
+    return Document(output, output_tokens)
@@ -2,10 +2,169 @@
 Module for working with zip codes
 '''
 
+from bisect import bisect_left
+from importlib.metadata import PackageNotFoundError, version
+from importlib.util import find_spec
 from statistics import median
+from threading import Lock
+import os
+import pickle
 import re
 
-import zipcodes
+from cache import CACHE_DIR
+
+
+
+ZIP_INDEX_PATH = os.path.join(CACHE_DIR, 'zip_index.pickle')
+ZIP_INDEX_FORMAT = 2 # change when the index changes, so old saved indexes are rebuilt
+
+
+
+class ZipIndex:
+    '''
+    Every US zip code from the `zipcodes` dataset, indexed so lookups don't have to scan the whole dataset.
+
+    - `records` maps each zip code to its record
+    - `city_zipcodes` maps each lowercase `(city, state)` to the zip code closest to the city's center
+    - `city_sizes` maps each lowercase `(city, state)` to its number of zip codes, a rough stand in for population
+    - `city_names` is every `'City, ST'` sorted by its lowercase form (`city_keys`), for finding cities by prefix
+    '''
+
+    __slots__ = ('version', 'records', 'city_zipcodes', 'city_sizes', 'city_names', 'city_keys')
+
+    def __init__(self, records: list[dict[str, str]]) -> None:
+        self.version = index_version()
+        self.records = {record['zip_code']: record for record in records}
+
+        by_city: dict[tuple[str, str], list[dict[str, str]]] = {}
+        names: dict[tuple[str, str], str] = {}
+
+        for record in records:
+            key = (record['city'].lower(), record['state'].lower())
+
+            by_city.setdefault(key, []).append(record)
+            names.setdefault(key, f"{record['city']}, {record['state']}")
+
+        self.city_zipcodes: dict[tuple[str, str], str] = {}
+        self.city_sizes = {key: len(city_records) for key, city_records in by_city.items()}
+
+        for key, city_records in by_city.items():
+            center_lat = median(float(record['lat']) for record in city_records)
+            center_long = median(float(record['long']) for record in city_records)
+
+            center = min(city_records, key=lambda record: (float(record['lat']) - center_lat) ** 2 + (float(record['long']) - center_long) ** 2)
+
+            self.city_zipcodes[key] = center['zip_code']
+
+        self.city_names = sorted(names.values(), key=str.lower)
+        self.city_keys = [name.lower() for name in self.city_names]
+
+    def get(self, zipcode: str) -> dict[str, str] | None:
+        return self.records.get(zipcode)
+
+    def city_zipcode(self, city: str, state: str) -> str | None:
+        '''
+        Returns the zip code closest to the center of `city`, or `None` if there is no such city.
+        '''
+
+        return self.city_zipcodes.get((city.lower(), state.lower()))
+
+    def city_size(self, city: str, state: str) -> int:
+        '''
+        Returns the number of zip codes in `city`, or 0 if there is no such city.
+        '''
+
+        return self.city_sizes.get((city.lower(), state.lower()), 0)
+
+    def complete_city(self, prefix: str, limit: int = 10) -> list[str]:
+        '''
+        Returns up to `limit` city names (as `'City, ST'`) starting with `prefix`, ignoring case.
+        '''
+
+        prefix = prefix.lower()
+        start = bisect_left(self.city_keys, prefix)
+
+        matches = []
+
+        for i in range(start, min(start + limit, len(self.city_keys))):
+            if not self.city_keys[i].startswith(prefix):
+                break
+
+            matches.append(self.city_names[i])
+
+        return matches
+
+
+
+_index: ZipIndex | None = None
+_index_lock = Lock()
+
+
+
+def _dataset_size() -> str:
+    '''
+    Returns the total size of the `zipcodes` package's files, which changes with its dataset, or 'unknown' if it can't be found.
+
+    Frozen builds can leave out the package metadata. Sizes are used instead of modification times, since one file builds extract their files again every run.
+    '''
+
+    spec = find_spec('zipcodes')
+
+    if spec is None or spec.origin is None or not os.path.isfile(spec.origin):
+        return 'unknown'
+
+    directory = os.path.dirname(spec.origin)
+
+    return str(sum(os.path.getsize(path) for path in (os.path.join(directory, name) for name in os.listdir(directory)) if os.path.isfile(path)))
+
+
+
+def index_version() -> str:
+    # read without importing zipcodes, so checking a saved index doesn't have to load the whole dataset
+    try:
+        dataset = version('zipcodes')
+    except PackageNotFoundError:
+        dataset = f'size-{_dataset_size()}'
+
+    return f'{dataset}.{ZIP_INDEX_FORMAT}'
+
+
+
+def get_zip_index() -> ZipIndex:
+    '''
+    Returns the shared zip code index.
+
+    The first call loads it from `ZIP_INDEX_PATH`, or builds and saves it if it's missing or out of date.
+    '''
+
+    global _index
+
+    with _index_lock:
+        if _index is not None:
+            return _index
+
+        try:
+            with open(ZIP_INDEX_PATH, 'rb') as f:
+                index = pickle.load(f)
+
+            if not isinstance(index, ZipIndex) or index.version != index_version():
+                raise ValueError('Outdated zip code index')
+
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            import zipcodes
+
+            index = ZipIndex(zipcodes.list_all())
+
+            os.makedirs(CACHE_DIR, exist_ok=True)
+
+            with open(ZIP_INDEX_PATH + '.tmp', 'wb') as f:
+                pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(ZIP_INDEX_PATH + '.tmp', ZIP_INDEX_PATH)
+
+        _index = index
+
+        return _index
 
 
 
@@ -18,15 +177,19 @@ class Zipcode:
 
     def __init__(self, zipcode: int | str) -> None:
         self.zipcode = str(zipcode)
-        self.is_real = zipcodes.is_real(self.zipcode)
 
-        if self.is_real:
-            self.data: dict[str, str] = zipcodes.matching(self.zipcode)[0]
+        # zip+4 codes are looked up by their first 5 digits
+        record = get_zip_index().get(self.zipcode[:5]) if re.fullmatch(r'\d{5}(?:-\d{4})?', self.zipcode) else None
+
+        self.is_real = record is not None
+
+        if record is not None:
+            self.data: dict[str, str] = record
 
             self.city = f'{self.data['city']}, {self.data['state']}'
 
-            self.lat: float = self.data['lat']   # type: ignore
-            self.long: float = self.data['long'] # type: ignore
+            self.lat = float(self.data['lat'])
+            self.long = float(self.data['long'])
 
         else:
             self.data = {}
@@ -38,21 +201,20 @@ class Zipcode:
 
     @classmethod
     def from_city(cls, city: str) -> 'Zipcode':
-        city, state = city.split(', ')
+        '''
+        Returns the zip code closest to the center of `city` (as `'City, ST'`).
 
-        city_zipcodes = zipcodes.filter_by(city=city, state=state)
+        Raises a `ValueError` if the city isn't in the dataset.
+        '''
 
-        lats = tuple(float(zipcode['lat']) for zipcode in city_zipcodes)
-        longs = tuple(float(zipcode['long']) for zipcode in city_zipcodes)
-
-        center_lat = median(lats)
-        center_long = median(longs)
+        city, state = city.split(', ')
 
-        zipcode_dict = min(city_zipcodes, key=lambda zipcode: ((float(zipcode['lat']) - center_lat) ** 2 + (float(zipcode['long']) - center_long) ** 2) ** 0.5)
+        zipcode = get_zip_index().city_zipcode(city, state)
 
-        zipcode = Zipcode(zipcode_dict['zip_code'])
+        if zipcode is None:
+            raise ValueError(f'Unknown city: {city}, {state}')
 
-        return zipcode
+        return cls(zipcode)
 
     @staticmethod
     def is_city(string: str) -> bool:
@@ -60,3 +222,40 @@ class Zipcode:
 
         return bool(re.match(regex, string))
 
+    @staticmethod
+    def complete_city(prefix: str, limit: int = 10) -> list[str]:
+        return get_zip_index().complete_city(prefix, limit)
+
+    def within(self, miles: float) -> list[tuple['Zipcode', float]]:
+        '''
+        Returns every zip code within `miles` miles of this one (including itself) with its distance, closest first.
+        '''
+
+        from spatial import get_zip_grid
+
+        zip_codes, distances = get_zip_grid().within(self.lat, self.long, miles)
+
+        return [(Zipcode(str(zipcode)), float(distance)) for zipcode, distance in zip(zip_codes, distances)]
+
+    def nearest(self, k: int) -> list[tuple['Zipcode', float]]:
+        '''
+        Returns the `k` zip codes closest to this one (including itself) with their distances, closest first.
+        '''
+
+        from spatial import get_zip_grid
+
+        zip_codes, distances = get_zip_grid().nearest(self.lat, self.long, k)
+
+        return [(Zipcode(str(zipcode)), float(distance)) for zipcode, distance in zip(zip_codes, distances)]
+
+    def cities_within(self, miles: float) -> dict[str, float]:
+        '''
+        Returns the name (as `'City, ST'`) of every city with a zip code within `miles` miles of this one, and the distance to its closest zip code, closest first.
+        '''
+
+        cities: dict[str, float] = {}
+
+        for zipcode, distance in self.within(miles):
+            cities.setdefault(zipcode.city, distance)
+
+        return cities